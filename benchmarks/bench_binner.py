@@ -0,0 +1,34 @@
+"""Benchmark the construction of the ring binner for a new calibration.
+
+Run it in an environment where pdfstream is installed::
+
+    python benchmarks/bench_binner.py --sizes 1024 2048
+"""
+import argparse
+import time
+
+from bench_masking import synthetic_detector
+
+from pdfstream.vend.masking import generate_map_bin, map_to_binner
+
+
+def main(sizes=(1024, 2048)):
+    print("{:>6} {:>12} {:>12}".format("size", "map bin (s)", "binner (s)"))
+    for size in sizes:
+        shape = (size, size)
+        # a new geometry has no arrays cached by pyFAI
+        ai = synthetic_detector(size)
+        t0 = time.perf_counter()
+        q, qbin = generate_map_bin(ai, shape)
+        t1 = time.perf_counter()
+        map_to_binner(q, qbin)
+        t2 = time.perf_counter()
+        print("{:>6} {:>12.3f} {:>12.3f}".format(size, t1 - t0, t2 - t1))
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048])
+    args = parser.parse_args()
+    main(args.sizes)
@@ -0,0 +1,73 @@
+"""Measure the peak memory of the auto masking of one frame for each engine.
+
+Each engine runs in a new process. The peak resident set size (VmHWM) is
+reset after the binner is created and the kernels are compiled, so the
+reported peak is the memory used by masking one frame on top of the image
+and the binner. It only runs on Linux. Run it in an environment where
+pdfstream is installed::
+
+    python benchmarks/bench_mask_memory.py --sizes 2048 4096
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+from bench_masking import synthetic_detector, synthetic_image
+
+from pdfstream.vend.masking import generate_binner, mask_img
+
+
+def _read_status(field: str) -> int:
+    """Read a memory field of this process in bytes from /proc."""
+    with Path("/proc/self/status").open("r") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+
+def _reset_peak() -> None:
+    """Reset the peak resident set size of this process to the current one."""
+    Path("/proc/self/clear_refs").write_text("5")
+
+
+def measure(size: int, engine: str) -> int:
+    """Return the peak memory in bytes of masking one frame."""
+    shape = (size, size)
+    ai = synthetic_detector(size)
+    binner = generate_binner(ai, shape)
+    img = synthetic_image(ai, shape)
+    # compile the kernels and fill the reused buffers
+    mask_img(img, binner, engine=engine)
+    _reset_peak()
+    before = _read_status("VmRSS")
+    mask_img(img, binner, engine=engine)
+    return _read_status("VmHWM") - before
+
+
+def main(sizes=(2048, 4096), engines=("thread", "numba", "tiled")):
+    print("{:>6} {:>10} {:>16}".format("size", "engine", "peak (MB/frame)"))
+    for size in sizes:
+        for engine in engines:
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", engine, str(size)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            peak = int(out.strip().splitlines()[-1])
+            print("{:>6} {:>10} {:>16.1f}".format(size, engine, peak / 2 ** 20))
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2048, 4096])
+    parser.add_argument("--engines", nargs="+", default=["thread", "numba", "tiled"])
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(measure(int(args.child[1]), args.child[0]))
+    else:
+        main(args.sizes, args.engines)
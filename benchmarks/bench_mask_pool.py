@@ -0,0 +1,58 @@
+"""Benchmark the per-frame latency of the threaded masking with a new pool
+for every frame and with the shared pool.
+
+Run it in an environment where pdfstream is installed::
+
+    python benchmarks/bench_mask_pool.py --size 2048 --frames 20
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bench_masking import synthetic_detector, synthetic_image
+from pdfstream.vend.masking import generate_binner, get_mask_pool, mask_img
+
+
+def per_frame_latency(imgs, binner, new_pool: bool) -> np.ndarray:
+    """Mask the frames one by one and return the latency of each frame."""
+    times = []
+    for img in imgs:
+        t0 = time.perf_counter()
+        if new_pool:
+            # the behavior before the shared pool
+            with ThreadPoolExecutor(max_workers=20) as pool:
+                mask_img(img, binner, engine="thread", pool=pool)
+        else:
+            mask_img(img, binner, engine="thread", pool=get_mask_pool())
+        times.append(time.perf_counter() - t0)
+    return np.array(times)
+
+
+def main(size=2048, frames=20):
+    shape = (size, size)
+    ai = synthetic_detector(size)
+    binner = generate_binner(ai, shape)
+    imgs = [synthetic_image(ai, shape, seed=i) for i in range(frames)]
+    # compile the kernels before timing
+    mask_img(imgs[0], binner, engine="thread")
+    new = per_frame_latency(imgs, binner, new_pool=True)
+    shared = per_frame_latency(imgs, binner, new_pool=False)
+    print("{:>12} {:>10} {:>10}".format("pool", "mean (ms)", "std (ms)"))
+    print("{:>12} {:>10.1f} {:>10.1f}".format("new", new.mean() * 1e3, new.std() * 1e3))
+    print(
+        "{:>12} {:>10.1f} {:>10.1f}".format(
+            "shared", shared.mean() * 1e3, shared.std() * 1e3
+        )
+    )
+    print("saved per frame: {:.1f} ms".format((new.mean() - shared.mean()) * 1e3))
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--frames", type=int, default=20)
+    args = parser.parse_args()
+    main(args.size, args.frames)
@@ -0,0 +1,76 @@
+"""Benchmark the engines of the binned outlier masking on synthetic detectors.
+
+Run it in an environment where pdfstream is installed::
+
+    python benchmarks/bench_masking.py --sizes 1024 2048 4096
+"""
+import argparse
+import time
+
+import numpy as np
+from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
+from pyFAI.detectors import Detector
+
+from pdfstream.vend.masking import generate_binner, mask_img
+
+
+def synthetic_detector(size: int, pixel: float = 200e-6) -> AzimuthalIntegrator:
+    """Create a square detector with the beam center in the middle."""
+    detector = Detector(pixel1=pixel, pixel2=pixel, max_shape=(size, size))
+    center = size * pixel / 2.0
+    return AzimuthalIntegrator(
+        dist=0.2, poni1=center, poni2=center, detector=detector, wavelength=1.671e-11
+    )
+
+
+def synthetic_image(
+    ai: AzimuthalIntegrator, shape: tuple, seed: int = 0, hot_fraction: float = 5e-4
+) -> np.ndarray:
+    """Create a powder diffraction like image with poisson noise and hot pixels."""
+    rng = np.random.default_rng(seed)
+    q = ai.qArray(shape) / 10.0
+    img = 1000.0 * np.exp(-q / 10.0) + 500.0 * np.sin(q * 3.0) ** 2
+    img = rng.poisson(img).astype(np.uint32)
+    hot = rng.integers(0, img.size, int(img.size * hot_fraction))
+    img.flat[hot] += 5000
+    return img
+
+
+def best_time(func, repeat: int) -> float:
+    """Return the best wall time of several runs."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main(sizes=(1024, 2048, 4096), engines=("thread", "vectorized", "numba"), repeat=3):
+    print("{:>6} {:>12} {:>10} {:>10}".format("size", "engine", "time (s)", "same"))
+    for size in sizes:
+        shape = (size, size)
+        ai = synthetic_detector(size)
+        binner = generate_binner(ai, shape)
+        img = synthetic_image(ai, shape)
+        expect = None
+        for engine in engines:
+            # compile and warm up the caches before timing
+            mask = mask_img(img, binner, engine=engine)
+            if expect is None:
+                expect = mask
+            t = best_time(lambda: mask_img(img, binner, engine=engine), repeat)
+            same = np.array_equal(mask, expect)
+            print("{:>6} {:>12} {:>10.3f} {:>10}".format(size, engine, t, str(same)))
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096])
+    parser.add_argument(
+        "--engines", nargs="+", default=["thread", "vectorized", "numba"]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.sizes, args.engines, args.repeat)
@@ -0,0 +1,130 @@
+"""The persistent caches of the data derived from the calibration."""
+import hashlib
+import json
+import shutil
+import tempfile
+import typing as T
+from pathlib import Path
+
+import numpy as np
+
+import pdfstream.io as io
+from pdfstream.vend.masking import RingIndex, generate_ring_index
+
+RING_INDEX_VERSION = "ring-index-v1"
+RING_INDEX_FIELDS = ("q", "bins", "argsort_index", "offsets")
+
+
+def hash_key(*objs: T.Any) -> str:
+    """Hash the json serializable objects and the numpy arrays to a hex string."""
+    h = hashlib.sha1()
+    for obj in objs:
+        if isinstance(obj, np.ndarray):
+            h.update(str((obj.dtype.str, obj.shape)).encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+        else:
+            h.update(json.dumps(obj, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def calib_key(calib: T.Mapping, shape: tuple) -> str:
+    """The key of the ring index of a calibration and an image shape."""
+    return hash_key(RING_INDEX_VERSION, dict(calib), list(shape))
+
+
+def load_arrays(
+    directory: T.Union[str, Path],
+    key: str,
+    fields: T.Sequence[str],
+    mmap_mode: T.Optional[str] = "r",
+) -> T.Optional[T.List[np.ndarray]]:
+    """Load the arrays saved by `save_arrays` from the cache directory.
+
+    Return None if the arrays are not in the cache or they are broken.
+    """
+    path = Path(directory).joinpath(key)
+    if not path.is_dir():
+        return None
+    try:
+        return [np.load(path.joinpath(f + ".npy"), mmap_mode=mmap_mode) for f in fields]
+    except (OSError, ValueError):
+        return None
+
+
+def save_arrays(
+    directory: T.Union[str, Path], key: str, arrays: T.Mapping[str, np.ndarray]
+) -> None:
+    """Save the arrays in a folder named by the key in the cache directory.
+
+    The arrays are written in a temporary directory first and then moved to
+    the cache so that other processes never read a half written cache.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    temp_dir = Path(tempfile.mkdtemp(dir=directory, prefix=".tmp-"))
+    try:
+        for f, array in arrays.items():
+            np.save(temp_dir.joinpath(f + ".npy"), array)
+        target = directory.joinpath(key)
+        # remove the broken cache
+        shutil.rmtree(target, ignore_errors=True)
+        temp_dir.replace(target)
+    except OSError:
+        # another process has saved the same arrays
+        pass
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return
+
+
+def load_ring_index(directory: T.Union[str, Path], key: str) -> T.Optional[RingIndex]:
+    """Load the ring index from the cache directory as memory mapped arrays.
+
+    Return None if the ring index is not in the cache or it is broken.
+    """
+    arrays = load_arrays(directory, key, RING_INDEX_FIELDS)
+    if arrays is None:
+        return None
+    return RingIndex(*arrays)
+
+
+def save_ring_index(
+    directory: T.Union[str, Path], key: str, ring_index: RingIndex
+) -> None:
+    """Save the ring index in the cache directory."""
+    save_arrays(
+        directory, key, {f: getattr(ring_index, f) for f in RING_INDEX_FIELDS}
+    )
+    return
+
+
+def get_ring_index(
+    ai, calib: T.Mapping, shape: tuple, directory: T.Union[str, Path]
+) -> RingIndex:
+    """Load the ring index from the cache directory or create and save it.
+
+    Parameters
+    ----------
+    ai : AzimuthalIntegrator
+        The AzimuthalIntegrator of the calibration.
+    calib : Mapping
+        The calibration data used in the key of the cache.
+    shape : tuple
+        The shape of the image.
+    directory : str or Path
+        The cache directory.
+
+    Returns
+    -------
+    RingIndex :
+        The pixels sorted by the rings.
+    """
+    key = calib_key(calib, shape)
+    ring_index = load_ring_index(directory, key)
+    if ring_index is not None and ring_index.q.shape == tuple(shape):
+        io.server_message("Load the ring index from the cache '{}'.".format(key))
+        return ring_index
+    ring_index = generate_ring_index(ai, shape)
+    save_ring_index(directory, key, ring_index)
+    io.server_message("Save the ring index in the cache '{}'.".format(key))
+    return ring_index
@@ -14,9 +14,19 @@ from pyFAI.io.ponifile import PoniFile
 from tifffile import TiffWriter
 
 import pdfstream.io as io
+from pdfstream.cache import get_ring_index, hash_key
 from pdfstream.callbacks.config import Config
 from pdfstream.callbacks.datakeys import DataKeys
-from pdfstream.vend.masking import generate_binner, mask_img_pyfai
+from pdfstream.callbacks.maskstore import MaskStore, StaticMask, mask_key
+from pdfstream.integration.sparse import get_integration_matrix, get_matrix_cache
+from pdfstream.vend.masking import (
+    generate_binner,
+    get_mask_pool,
+    mask_drift,
+    mask_img_pyfai,
+    prior_mask,
+    set_mask_pool_size,
+)
 from pdfstream.data import ni_dspacing_file
 
 try:
@@ -62,9 +72,11 @@ def _get_pyfai(calib: frozendict) -> AzimuthalIntegrator:
 
 
 @lru_cache(maxsize=16)
-def _get_binner(calib: frozendict, shape: tuple):
+def _get_binner(calib: frozendict, shape: tuple, cache_dir: str = None):
     ai = _get_pyfai(calib)
-    return generate_binner(ai, shape)
+    if cache_dir is None:
+        return generate_binner(ai, shape)
+    return get_ring_index(ai, calib, shape, cache_dir)
 
 
 def _write_tiff(image: np.ndarray, filepath: str) -> None:
@@ -126,6 +138,13 @@ class Analyzer(event_model.DocumentRouter):
         self._datakeys: DataKeys = datakeys
         self._default_config = default_config
         self._config: Config = default_config
+        set_mask_pool_size(default_config.mask_pool_size)
+        get_matrix_cache().maxsize = default_config.integ_matrix_size
+        self._mask_store = MaskStore(
+            default_config.mask_store_size,
+            default_config.mask_store_dir,
+            default_config.mask_store_disk_size,
+        )
         self._set_pdfgetter()
         self.clear_cache()
 
@@ -139,6 +158,8 @@ class Analyzer(event_model.DocumentRouter):
         self._calib_keys: T.Optional[CalibKeys] = None
         self._calib_data: T.Optional[CalibData] = None
         self._user_mask: T.Optional[np.ndarray] = None
+        self._user_mask_key: T.Optional[str] = None
+        self._static_masks: T.Dict[str, StaticMask] = dict()
         self._calib_descriptor: str = ""
         self._primary_descriptor: str = ""
         self._mask_descriptor: str = ""
@@ -237,7 +258,8 @@ class Analyzer(event_model.DocumentRouter):
 
     def _average_frames(self, data: dict) -> None:
         keys = self._datakeys
-        dtype = self._config.image_dtype
+        # the masking and integration run in the compute_dtype if it is set
+        dtype = self._config.compute_dtype or self._config.image_dtype
         image: np.ndarray = np.array(data[keys.image], dtype=dtype)
         if image.ndim == 3:
             data[keys.image] = np.mean(image, axis=0, dtype=image.dtype)
@@ -252,7 +274,7 @@ class Analyzer(event_model.DocumentRouter):
 
     def _set_default(self, data: dict) -> None:
         keys = self._datakeys
-        data[keys.mask] = np.zeros_like(data[keys.image], dtype=int)
+        data[keys.mask] = np.zeros_like(data[keys.image], dtype=bool)
         for k in keys.get_1d_arrays():
             data[k] = np.array([0.0])
         for k in keys.get_scalar():
@@ -275,6 +297,58 @@ class Analyzer(event_model.DocumentRouter):
         self._calib_data = _load_calib(poni_file)
         return
 
+    def _get_auto_mask(
+        self, image: np.ndarray, binner: T.Any, user_mask: T.Optional[np.ndarray]
+    ) -> np.ndarray:
+        mask_setting = self._config.mask_setting
+        return mask_img_pyfai(
+            image, binner, user_mask, pool=get_mask_pool(), **mask_setting
+        )
+
+    def _get_prior_mask(
+        self, image: np.ndarray, user_mask: T.Optional[np.ndarray], thresh: bool = True
+    ) -> np.ndarray:
+        mask_setting = self._config.mask_setting
+        return prior_mask(
+            image,
+            edge=mask_setting["edge"],
+            lower_thresh=mask_setting["lower_thresh"] if thresh else None,
+            upper_thresh=mask_setting["upper_thresh"] if thresh else None,
+            tmsk=np.invert(user_mask.astype(bool)) if user_mask is not None else None,
+        )
+
+    def _is_mask_outdated(
+        self,
+        static_mask: StaticMask,
+        image: np.ndarray,
+        binner: T.Any,
+        user_mask: T.Optional[np.ndarray],
+    ) -> bool:
+        config = self._config
+        policy = config.mask_policy
+        if policy == "first_frame":
+            return False
+        if policy == "every_n":
+            return static_mask.frames >= config.mask_every_n
+        if not static_mask.has_stats:
+            return True
+        mask_setting = config.mask_setting
+        tmsk = self._get_prior_mask(image, user_mask, thresh=False)
+        drift = mask_drift(
+            image,
+            binner,
+            np.invert(static_mask.mask.astype(bool)),
+            static_mask.median,
+            static_mask.std,
+            alpha=mask_setting["alpha"],
+            fraction=config.mask_drift_fraction,
+            tmsk=tmsk,
+            lower_thresh=mask_setting["lower_thresh"],
+            upper_thresh=mask_setting["upper_thresh"],
+        )
+        io.server_message("Mask drift is {:.4f}.".format(drift))
+        return drift > config.mask_drift_tolerance
+
     def _auto_mask(
         self,
         data: dict,
@@ -282,10 +356,34 @@ class Analyzer(event_model.DocumentRouter):
         user_mask: T.Optional[np.ndarray],
         calib: frozendict,
     ) -> None:
-        mask_setting = self._config.mask_setting
         image = data[keys.image]
-        binner = _get_binner(calib, image.shape)
-        data[keys.mask] = mask_img_pyfai(image, binner, user_mask, **mask_setting)
+        binner = _get_binner(calib, image.shape, self._config.ring_cache_dir)
+        if self._config.mask_policy == "every_frame":
+            data[keys.mask] = self._get_auto_mask(image, binner, user_mask)
+            return
+        user_mask_key = self._user_mask_key if user_mask is not None else None
+        key = mask_key(calib, user_mask_key, self._config.mask_setting, image.shape)
+        static_mask = self._static_masks.get(key)
+        if static_mask is None:
+            static_mask = self._mask_store.get(key)
+            if static_mask is not None:
+                io.server_message("Load the static mask from the mask store.")
+        if static_mask is None or self._is_mask_outdated(
+            static_mask, image, binner, user_mask
+        ):
+            mask = self._get_auto_mask(image, binner, user_mask)
+            if self._config.mask_policy == "on_drift":
+                prior = self._get_prior_mask(image, user_mask)
+                static_mask = StaticMask.from_image(image, binner, mask, prior)
+            else:
+                static_mask = StaticMask(mask)
+            self._mask_store.put(key, static_mask)
+            io.server_message("Update the static mask.")
+        else:
+            io.server_message("Reuse the static mask.")
+        self._static_masks[key] = static_mask
+        static_mask.frames += 1
+        data[keys.mask] = static_mask.mask
         return
 
     def _update_mask(self, data: dict) -> None:
@@ -295,13 +393,18 @@ class Analyzer(event_model.DocumentRouter):
         is_auto_mask = self._config.auto_mask
         user_mask = self._user_mask
         image_shape = data[keys.image].shape
-        if (user_mask is not None) and (user_mask.shape != image_shape):
-            io.server_message(
-                "User mask shape {} != image shape {}.".format(
-                    user_mask.shape, image_shape
+        if user_mask is not None:
+            try:
+                user_mask = io.unpack_mask(user_mask, image_shape)
+            except ValueError:
+                io.server_message(
+                    "User mask shape {} != image shape {}.".format(
+                        user_mask.shape, image_shape
+                    )
                 )
-            )
-            user_mask = None
+                user_mask = None
+            else:
+                self._user_mask = user_mask
         if is_auto_mask:
             self._auto_mask(data, keys, user_mask, calib)
             io.server_message("Do auto masking.")
@@ -322,9 +425,19 @@ class Analyzer(event_model.DocumentRouter):
         keys = self._datakeys
         ai = _get_pyfai(calib)
         integ_setting = self._config.integ_setting
-        tth, intensity = ai.integrate1d(
-            data[keys.image], mask=data[keys.mask], **integ_setting
-        )
+        if self._config.use_integ_matrix:
+            matrix = get_integration_matrix(
+                ai,
+                data[keys.image].shape,
+                data[keys.mask],
+                integ_setting,
+                directory=self._config.integ_matrix_dir,
+            )
+            tth, intensity = matrix.x, matrix.integrate(data[keys.image])
+        else:
+            tth, intensity = ai.integrate1d(
+                data[keys.image], mask=data[keys.mask], **integ_setting
+            )
         data[keys.chi_2theta] = tth
         data[keys.chi_Q] = self._get_q(tth, ai.wavelength)
         data[keys.chi_I] = intensity
@@ -366,10 +479,17 @@ class Analyzer(event_model.DocumentRouter):
             self._pyfai_calibrate(data)
         if self._calib_data is None:
             io.server_message("No calibration data. Skip all following steps.")
-            return
-        self._update_mask(data)
-        self._update_chi(data)
-        self._update_gr(data)
+        else:
+            self._update_mask(data)
+            self._update_chi(data)
+            self._update_gr(data)
+        if self._config.pack_mask:
+            data[self._datakeys.mask] = io.pack_mask(data[self._datakeys.mask])
+        else:
+            # the published mask is the int array of the image shape as before
+            data[self._datakeys.mask] = np.asarray(
+                data[self._datakeys.mask], dtype=np.int64
+            )
         return
 
     def _save_pyfai_data(self, data: dict) -> None:
@@ -440,12 +560,18 @@ class Analyzer(event_model.DocumentRouter):
         return
 
     def _set_user_mask(self, doc: dict) -> None:
-        self._user_mask = np.array(doc["data"][self._datakeys.mask], dtype=np.int64)
+        self._user_mask = np.asarray(doc["data"][self._datakeys.mask])
+        self._user_mask_key = hash_key(self._user_mask)
         return
 
     def start(self, doc):
         self.clear_cache()
         self._set_config(doc)
+        if self._config.integ_matrix and not self._config.use_integ_matrix:
+            io.server_message(
+                "Warning: the auto mask changes in every frame. "
+                "Integrate by pyFAI instead of the integration matrix."
+            )
         self._set_pyfai_calib_kwargs(doc)
         self._set_and_mk_dirs(doc)
         return doc
@@ -480,3 +606,9 @@ class Analyzer(event_model.DocumentRouter):
             event = self.event(event_doc)
             events.append(event)
         return event_model.pack_event_page(*events)
+
+    def stop(self, doc):
+        self._mask_store.report()
+        if self._config.use_integ_matrix:
+            get_matrix_cache().report()
+        return doc
@@ -5,6 +5,7 @@ from bluesky.callbacks.zmq import RemoteDispatcher
 from pdfstream.callbacks.analysispipeline import AnalysisPipeline
 from pdfstream.callbacks.config import Config
 from pdfstream.io import server_message
+from pdfstream.vend.masking import shutdown_mask_pool
 
 PipeLine = T.ClassVar[Config]
 
@@ -21,6 +22,8 @@ class AnalysisServer(RemoteDispatcher):
             super().start()
         except KeyboardInterrupt:
             pass
+        finally:
+            shutdown_mask_pool()
         return
 
 
@@ -3,8 +3,11 @@ from configparser import ConfigParser
 from functools import cached_property
 from pathlib import Path
 
+import pdfstream.data
 import pdfstream.io as io
 from pdfstream.callbacks.datakeys import DataKeys
+from pdfstream.callbacks.maskstore import MASK_POLICIES
+from pdfstream.vend.masking import AUTO_TYPES, MASK_ENGINES
 from pdfstream.vend.formatters import SpecialStr
 
 SectionDict = T.Dict[str, str]
@@ -20,12 +23,29 @@ DEFAULT_CONFIGURE = {
         "detectors": "pe1, pe2 ,dexela",
         "image_fields": "pe1_image, pe2_image, dexela",
         "image_dtype": "uint32",
+        "compute_dtype": None,
         "fill": True,
         "auto_mask": True,
         "alpha": 2.0,
         "edge": 20,
         "lower_thresh": 0.0,
         "upper_thresh": None,
+        "auto_type": "median",
+        "mask_engine": None,
+        "mask_pool_size": 20,
+        "mask_policy": "every_frame",
+        "mask_every_n": 10,
+        "mask_drift_fraction": 0.01,
+        "mask_drift_tolerance": 0.01,
+        "mask_store_size": 8,
+        "mask_store_disk": False,
+        "mask_store_disk_size": 64,
+        "pack_mask": False,
+        "ring_cache": True,
+        "integ_matrix": False,
+        "integ_matrix_size": 2,
+        "integ_matrix_disk": False,
+        "cache_dir": None,
         "npt": 3000,
         "correctSolidAngle": False,
         "polarization_factor": 0.99,
@@ -83,6 +103,26 @@ class Config(ConfigParser):
     def getset(self, section: str, option: str) -> T.Set[str]:
         return set(self.getlist(section, option))
 
+    def getoptfloat(self, section: str, option: str) -> T.Optional[float]:
+        value: str = self.get(section, option, fallback=None)
+        if not value:
+            return None
+        return float(value)
+
+    def getoptchoice(
+        self, section: str, option: str, choices: T.Sequence[str]
+    ) -> T.Optional[str]:
+        value: str = self.get(section, option, fallback=None)
+        if not value:
+            return None
+        if value not in choices:
+            raise ConfigError(
+                "Unknown {} '{}'. Allowed: {}.".format(
+                    option, value, ", ".join(choices)
+                )
+            )
+        return value
+
     @cached_property
     def sample_name(self) -> str:
         return self.get("METADATA", "sample_name")
@@ -103,6 +143,11 @@ class Config(ConfigParser):
     def image_dtype(self) -> str:
         return self.get("ANALYSIS", "image_dtype")
 
+    @cached_property
+    def compute_dtype(self) -> T.Optional[str]:
+        value = self.get("ANALYSIS", "compute_dtype", fallback=None)
+        return value if value else None
+
     @cached_property
     def detectors(self) -> T.List:
         return self.getlist("ANALYSIS", "detectors")
@@ -117,13 +162,100 @@ class Config(ConfigParser):
 
     @cached_property
     def mask_setting(self) -> dict:
+        auto_type = self.getoptchoice("ANALYSIS", "auto_type", AUTO_TYPES) or "median"
+        engine = self.getoptchoice("ANALYSIS", "mask_engine", MASK_ENGINES)
+        if engine == "vectorized" and auto_type != "median":
+            raise ConfigError(
+                "The mask_engine 'vectorized' only supports the auto_type 'median'."
+            )
         return {
             "alpha": self.getfloat("ANALYSIS", "alpha"),
             "edge": self.getint("ANALYSIS", "edge"),
             "lower_thresh": self.getfloat("ANALYSIS", "lower_thresh"),
-            "upper_thresh": self.get("ANALYSIS", "upper_thresh"),
+            "upper_thresh": self.getoptfloat("ANALYSIS", "upper_thresh"),
+            "auto_type": auto_type,
+            "engine": engine,
         }
 
+    @cached_property
+    def mask_policy(self) -> str:
+        return (
+            self.getoptchoice("ANALYSIS", "mask_policy", MASK_POLICIES)
+            or "every_frame"
+        )
+
+    @cached_property
+    def mask_every_n(self) -> int:
+        return self.getint("ANALYSIS", "mask_every_n", fallback=10)
+
+    @cached_property
+    def mask_drift_fraction(self) -> float:
+        return self.getfloat("ANALYSIS", "mask_drift_fraction", fallback=0.01)
+
+    @cached_property
+    def mask_drift_tolerance(self) -> float:
+        return self.getfloat("ANALYSIS", "mask_drift_tolerance", fallback=0.01)
+
+    @cached_property
+    def mask_store_size(self) -> int:
+        return self.getint("ANALYSIS", "mask_store_size", fallback=8)
+
+    @cached_property
+    def mask_store_dir(self) -> T.Optional[str]:
+        if not self.getboolean("ANALYSIS", "mask_store_disk", fallback=False):
+            return None
+        return str(self.cache_dir.joinpath("masks"))
+
+    @cached_property
+    def mask_store_disk_size(self) -> int:
+        return self.getint("ANALYSIS", "mask_store_disk_size", fallback=64)
+
+    @cached_property
+    def pack_mask(self) -> bool:
+        return self.getboolean("ANALYSIS", "pack_mask", fallback=False)
+
+    @cached_property
+    def mask_pool_size(self) -> int:
+        return self.getint("ANALYSIS", "mask_pool_size", fallback=20)
+
+    @cached_property
+    def cache_dir(self) -> Path:
+        cache_dir = self.get("ANALYSIS", "cache_dir", fallback=None)
+        return Path(cache_dir).expanduser() if cache_dir else pdfstream.data.cache_dir
+
+    @cached_property
+    def ring_cache_dir(self) -> T.Optional[str]:
+        if not self.getboolean("ANALYSIS", "ring_cache", fallback=True):
+            return None
+        return str(self.cache_dir.joinpath("rings"))
+
+    @cached_property
+    def integ_matrix(self) -> bool:
+        return self.getboolean("ANALYSIS", "integ_matrix", fallback=False)
+
+    @cached_property
+    def is_static_mask(self) -> bool:
+        """True if the mask is reused across the frames in a run."""
+        return not self.auto_mask or self.mask_policy != "every_frame"
+
+    @cached_property
+    def use_integ_matrix(self) -> bool:
+        """True if the images are integrated by the matrix.
+
+        The matrix is only reused when the mask is static.
+        """
+        return self.integ_matrix and self.is_static_mask
+
+    @cached_property
+    def integ_matrix_size(self) -> int:
+        return self.getint("ANALYSIS", "integ_matrix_size", fallback=2)
+
+    @cached_property
+    def integ_matrix_dir(self) -> T.Optional[str]:
+        if not self.getboolean("ANALYSIS", "integ_matrix_disk", fallback=False):
+            return None
+        return str(self.cache_dir.joinpath("matrices"))
+
     @cached_property
     def integ_setting(self) -> dict:
         return {
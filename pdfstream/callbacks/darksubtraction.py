@@ -3,6 +3,8 @@ import time
 import event_model
 import numpy
 
+from pdfstream.integration.tools import sub_images
+
 
 class DarkSubtractionError(Exception):
 
@@ -136,4 +138,9 @@ class DarkSubtraction(event_model.DocumentRouter):
 
     @staticmethod
     def subtract(light, dark):
-        return numpy.clip(light - dark, a_min=0, a_max=None).astype(light.dtype)
+        # subtract and clip each frame in one pass into the output
+        out = numpy.empty(light.shape, dtype=light.dtype)
+        frames = numpy.reshape(light, (-1,) + dark.shape)
+        for frame, frame_out in zip(frames, out.reshape(frames.shape)):
+            sub_images(frame, dark, lower=0.0, out=frame_out)
+        return out
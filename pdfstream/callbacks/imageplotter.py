@@ -47,7 +47,9 @@ class ImagePlotter(PlotterBase):
             io.server_message("No '{}' in data.".format(self.image_field))
             return
         mask = doc["data"][self.mask_field] if self.mask_field in doc["data"] else None
-        image = doc["data"][self.image_field]
+        image = np.asarray(doc["data"][self.image_field])
+        if mask is not None:
+            mask = io.unpack_mask(mask, image.shape)
         data_arr = np.ma.masked_array(image, mask)
         self.update(data_arr)
         self._updated = True
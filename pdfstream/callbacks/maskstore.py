@@ -0,0 +1,200 @@
+import os
+import shutil
+import typing as T
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import pdfstream.io as io
+from pdfstream.cache import hash_key, load_arrays, save_arrays
+from pdfstream.vend.masking import ring_segments, ring_stats
+
+MASK_POLICIES = ("every_frame", "first_frame", "every_n", "on_drift")
+MASK_STORE_VERSION = "mask-store-v1"
+STATIC_MASK_FIELDS = ("mask", "median", "std")
+
+
+class StaticMask:
+    """The auto mask reused for the following frames.
+
+    It keeps the statistics of the rings in the image that the mask is
+    calculated from so that the drift of the new images can be checked.
+
+    Parameters
+    ----------
+    mask : ndarray
+        The mask in pyFAI convention. 0 are good pixels, 1 are masked out.
+    median : ndarray
+        The median of each ring in the pixels before the outlier masking. It
+        is empty if the statistics are not calculated.
+    std : ndarray
+        The standard deviation of each ring in the pixels before the outlier
+        masking. It is empty if the statistics are not calculated.
+    """
+
+    def __init__(
+        self,
+        mask: np.ndarray,
+        median: T.Optional[np.ndarray] = None,
+        std: T.Optional[np.ndarray] = None,
+    ):
+        self.mask = mask
+        self.median = np.empty(0) if median is None else median
+        self.std = np.empty(0) if std is None else std
+        self.frames = 0
+
+    @property
+    def has_stats(self) -> bool:
+        """True if the ring statistics are calculated."""
+        return self.median.size > 0
+
+    @classmethod
+    def from_image(
+        cls, image: np.ndarray, binner: T.Any, mask: np.ndarray, prior: np.ndarray
+    ):
+        """Calculate the ring statistics of the image and keep them with the mask.
+
+        The statistics are calculated from the good pixels in the prior mask,
+        which is the mask before the outlier masking, so that they are the
+        same as those used to find the outliers.
+        """
+        values, _, offsets = ring_segments(image, binner, prior)
+        median, std = ring_stats(values, offsets)
+        return cls(mask, median, std)
+
+
+def mask_key(
+    calib: T.Mapping,
+    user_mask_key: T.Optional[str],
+    mask_setting: T.Mapping,
+    shape: tuple,
+) -> str:
+    """The key of the auto mask in the mask store.
+
+    The engine in the mask setting is not in the key because all engines
+    give the same mask.
+    """
+    setting = {k: v for k, v in mask_setting.items() if k != "engine"}
+    return hash_key(
+        MASK_STORE_VERSION, dict(calib), user_mask_key, setting, list(shape)
+    )
+
+
+class MaskStore:
+    """The least recently used store of the auto masks shared by the runs.
+
+    The masks are kept in the memory and optionally in a directory on the
+    disk so that they survive the restart of the server.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of the masks in the memory. If 0, nothing is kept
+        in the memory.
+    directory : str or Path, optional
+        The directory to save the masks. If None, the masks are not saved.
+    disk_maxsize : int
+        The maximum number of the masks in the directory.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 8,
+        directory: T.Union[None, str, Path] = None,
+        disk_maxsize: int = 64,
+    ):
+        self.maxsize = maxsize
+        self.directory = Path(directory) if directory else None
+        self.disk_maxsize = disk_maxsize
+        self.hits = 0
+        self.misses = 0
+        self._masks: T.Dict[str, StaticMask] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._masks)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._masks
+
+    def get(self, key: str) -> T.Optional[StaticMask]:
+        """Get a copy of the mask from the memory or the disk.
+
+        The frame counter of the copy starts from zero so that the policy of
+        the run is applied from the beginning.
+        """
+        static_mask = self._masks.get(key)
+        if static_mask is not None:
+            self._masks.move_to_end(key)
+        else:
+            static_mask = self._load(key)
+            if static_mask is not None:
+                self._remember(key, static_mask)
+        if static_mask is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return StaticMask(static_mask.mask, static_mask.median, static_mask.std)
+
+    def put(self, key: str, static_mask: StaticMask) -> None:
+        """Put the mask in the store and evict the least recently used ones."""
+        self._remember(key, static_mask)
+        if self.directory is not None and self.disk_maxsize > 0:
+            save_arrays(
+                self.directory,
+                key,
+                {f: getattr(static_mask, f) for f in STATIC_MASK_FIELDS},
+            )
+            self._evict_disk()
+        return
+
+    def clear(self) -> None:
+        """Clear the masks in the memory and the counters."""
+        self._masks.clear()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def report(self) -> None:
+        """Send the hit and miss counters to the server message."""
+        if self.hits + self.misses == 0:
+            return
+        io.server_message(
+            "Mask store: {} hits, {} misses, {} masks in memory.".format(
+                self.hits, self.misses, len(self._masks)
+            )
+        )
+        return
+
+    def _remember(self, key: str, static_mask: StaticMask) -> None:
+        if self.maxsize <= 0:
+            return
+        self._masks[key] = static_mask
+        self._masks.move_to_end(key)
+        while len(self._masks) > self.maxsize:
+            self._masks.popitem(last=False)
+        return
+
+    def _load(self, key: str) -> T.Optional[StaticMask]:
+        if self.directory is None:
+            return None
+        arrays = load_arrays(self.directory, key, STATIC_MASK_FIELDS, mmap_mode=None)
+        if arrays is None:
+            return None
+        # record the use for the eviction on the disk
+        try:
+            os.utime(self.directory.joinpath(key))
+        except OSError:
+            pass
+        return StaticMask(*arrays)
+
+    def _evict_disk(self) -> None:
+        folders = [
+            d
+            for d in self.directory.iterdir()
+            if d.is_dir() and not d.name.startswith(".")
+        ]
+        folders.sort(key=lambda d: d.stat().st_mtime)
+        for d in folders[: max(len(folders) - self.disk_maxsize, 0)]:
+            shutil.rmtree(d, ignore_errors=True)
+        return
@@ -15,9 +15,11 @@ class NumpySerializer(SerializerBase):
         fields: T.List[str],
         stream_name: str = "primary",
         folder: str = "mask",
+        image_fields: T.List[str] = None,
     ) -> None:
         super().__init__(base, folder)
         self._fields = fields
+        self._image_fields = dict(zip(fields, image_fields)) if image_fields else {}
         self._stream_name = stream_name
         self._descriptor = ""
 
@@ -30,7 +32,14 @@ class NumpySerializer(SerializerBase):
         if field in doc["data"]:
             f = self._get_filepath(doc["data"]["filename"], field)
             a = doc["data"][field]
-            np.save(f, a)
+            image_field = self._image_fields.get(field)
+            if image_field in doc["data"]:
+                # save the mask as bits with the shape of the image
+                shape = np.shape(doc["data"][image_field])[-2:]
+                f = f.with_suffix(".npz")
+                io.save_mask(str(f), io.unpack_mask(a, shape))
+            else:
+                np.save(f, a)
             io.server_message("Save '{}' in '{}'".format(field, f.name))
         else:
             io.server_message("Missing '{}' in data.".format(field))
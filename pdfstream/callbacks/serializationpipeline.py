@@ -18,7 +18,9 @@ class SerializationPipeline:
         self._tiff_serilizers = [
             TiffSerializer(d, images, image_dtype) for d in tiff_base
         ]
-        self._numpy_serializers = [NumpySerializer(d, masks) for d in tiff_base]
+        self._numpy_serializers = [
+            NumpySerializer(d, masks, image_fields=images) for d in tiff_base
+        ]
         return
 
     def __call__(self, name, doc):
@@ -1,15 +1,23 @@
 """The functions used in the command line interface. The input and output are all files."""
 import typing as tp
+import warnings
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path, PurePath
 
 import matplotlib.pyplot as plt
-import numpy as np
 from matplotlib.axes import Axes
+from numpy import ndarray
+from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
 
 import pdfstream.integration as integ
 import pdfstream.io as io
 import pdfstream.visualization as vis
+from pdfstream.cache import RING_INDEX_FIELDS
+from pdfstream.integration.tools import as_compute_dtype, bg_file_key
+from pdfstream.prefetch import PrefetchReader
+from pdfstream.sharedmem import SharedArrays, attach_arrays, detach_arrays
+from pdfstream.vend.masking import RingIndex, generate_ring_index
+from pdfstream.watch import DirectoryWatcher, Manifest, file_state
 
 
 def integrate(
@@ -23,7 +31,12 @@ def integrate(
     integ_setting: dict = None,
     plot_setting: tp.Union[dict, str] = None,
     img_setting: tp.Union[dict, str] = None,
+    dtype: str = None,
+    use_matrix: bool = False,
+    bg_mode: str = "2d",
     parallel: bool = False,
+    prefetch: int = 4,
+    prefetch_threads: int = 2,
     test: bool = False
 ) -> tp.List[str]:
     """Conduct azimuthal integration on the two dimensional diffraction images.
@@ -47,7 +60,8 @@ def integrate(
         no background subtraction will be done.
 
     mask_file : str
-        The .npy file of the mask array. Use pyFai convention. 1 are masked pixels, 0 are good pixels.
+        The .npy file of the mask array or the .npz file of the packed mask saved by the analysis server. Use
+        pyFai convention. 1 are masked pixels, 0 are good pixels.
 
     output_dir : str
         The directory to save the chi data file. Default current working directory.
@@ -75,8 +89,31 @@ def integrate(
         'z_score', which determines the range of the colormap. The range is mean +/- z_score * std in the
         statistics of the image. To turn of the image, enter "OFF".
 
+    dtype : str
+        The data type of the computation. Use "float32" to run the subtraction, masking and integration in
+        single precision with half the memory. If None, the integer images are processed in float64.
+
+    use_matrix : bool
+        If True, integrate by the sparse integration matrix built once for the geometry, mask and integration
+        setting. It is faster when all images share the mask, like with a mask file and mask_setting="OFF".
+
+    bg_mode : str
+        "2d" subtracts the background image before the masking and integration. "1d" integrates the background
+        once and subtracts the scaled curve from the integrated images. It is exact when the images share the
+        mask, like with mask_setting="OFF". With the auto masking, a warning is emitted because the mask differs
+        per image and is calculated without the background subtraction.
+
     parallel : bool
-        If True, run the processing in multiple process.
+        If True, run the processing in multiple process. The background image, mask and ring index of the auto
+        masking are published once in the shared memory and the processes use them without copy.
+
+    prefetch : int
+        The maximum number of the images read ahead in the background threads so that the reading overlaps with
+        the processing. If 0, the images are read one by one. Not used in the parallel mode. The queue depth and
+        the time waiting for the images are reported at the end.
+
+    prefetch_threads : int
+        The number of the threads to read the images ahead.
 
     test : bool
         If True, run in test mode (for developers).
@@ -87,64 +124,145 @@ def integrate(
         The path to the output chi file.
     """
     Path(output_dir).mkdir(parents=True, exist_ok=True)
-    if parallel:
-        executor = ProcessPoolExecutor() if not test else ThreadPoolExecutor()
-        jobs = [
-            executor.submit(
-                _integrate,
-                poni_file,
-                img_file,
-                bg_img_file=bg_img_file,
-                mask_file=mask_file,
-                output_dir=output_dir,
-                bg_scale=bg_scale,
-                mask_setting=mask_setting,
-                integ_setting=integ_setting,
-                plot_setting=plot_setting,
-                img_setting=img_setting,
-                test=test,
-            )
-            for img_file in img_files
-        ]
-        return [job.result() for job in as_completed(jobs)]
-    return [
-        _integrate(
-            poni_file,
-            img_file,
-            bg_img_file=bg_img_file,
-            mask_file=mask_file,
-            output_dir=output_dir,
-            bg_scale=bg_scale,
-            mask_setting=mask_setting,
-            integ_setting=integ_setting,
-            plot_setting=plot_setting,
-            img_setting=img_setting,
-            test=test,
+    if bg_mode == "1d" and bg_img_file and mask_setting != "OFF":
+        warnings.warn(
+            "The auto mask differs per image and is calculated without the background subtraction. "
+            "The results of bg_mode='1d' may differ from bg_mode='2d'. Use mask_setting='OFF' for exact results."
         )
-        for img_file in img_files
-    ]
+    kwargs = dict(
+        output_dir=output_dir,
+        bg_scale=bg_scale,
+        mask_setting=mask_setting,
+        integ_setting=integ_setting,
+        plot_setting=plot_setting,
+        img_setting=img_setting,
+        dtype=dtype,
+        use_matrix=use_matrix,
+        bg_mode=bg_mode,
+        test=test,
+    )
+    if parallel:
+        # the ring index of the auto masking is created for the shape of the first image
+        shape = io.load_img(img_files[0]).shape if img_files and mask_setting != "OFF" else None
+        shared_inputs = _load_shared_inputs(poni_file, bg_img_file, mask_file, dtype, shape)
+        executor_class = ProcessPoolExecutor if not test else ThreadPoolExecutor
+        # the arrays are published once and the workers attach them without copy
+        with SharedArrays() as shared:
+            _publish_shared_inputs(shared, shared_inputs)
+            initargs = (poni_file, shared.specs, shared_inputs["bg_key"])
+            try:
+                with executor_class(initializer=_init_worker, initargs=initargs) as executor:
+                    jobs = [
+                        executor.submit(_integrate_in_worker, img_file, **kwargs)
+                        for img_file in img_files
+                    ]
+                    return [job.result() for job in as_completed(jobs)]
+            finally:
+                _SHARED_INPUTS.clear()
+                detach_arrays()
+    shared_inputs = _load_shared_inputs(poni_file, bg_img_file, mask_file, dtype)
+    reader = PrefetchReader(img_files, depth=prefetch, threads=prefetch_threads)
+    chi_files = []
+    for img_file, img in reader:
+        _set_binner(shared_inputs, img, mask_setting)
+        chi_files.append(_integrate(img_file, img=img, **shared_inputs, **kwargs))
+    reader.report()
+    return chi_files
+
+
+# the inputs shared by all the image files in a worker process
+_SHARED_INPUTS = dict()
+
+
+def _load_shared_inputs(
+    poni_file: str,
+    bg_img_file: str = None,
+    mask_file: str = None,
+    dtype: str = None,
+    shape: tuple = None,
+) -> dict:
+    """Load the geometry, background image and mask shared by all the image files and create the ring index of
+    the auto masking if the image shape is given."""
+    ai = io.load_ai_from_poni_file(poni_file)
+    bg_img = io.load_img(bg_img_file) if bg_img_file else None
+    return {
+        "ai": ai,
+        "bg_img": as_compute_dtype(bg_img, dtype),
+        "bg_key": bg_file_key(bg_img_file, dtype) if bg_img_file else None,
+        "mask": io.load_mask(mask_file) if mask_file else None,
+        "binner": generate_ring_index(ai, shape) if shape is not None else None,
+    }
+
+
+def _set_binner(shared_inputs: dict, img: ndarray, mask_setting: tp.Union[dict, str] = None) -> None:
+    """Create the ring index of the auto masking for the shape of the first image if it is not created."""
+    if mask_setting != "OFF" and shared_inputs["binner"] is None:
+        shared_inputs["binner"] = generate_ring_index(shared_inputs["ai"], img.shape)
+    return
+
+
+def _publish_shared_inputs(shared: SharedArrays, shared_inputs: dict) -> None:
+    """Publish the arrays in the shared inputs, including those of the ring index."""
+    shared.publish("bg_img", shared_inputs["bg_img"])
+    shared.publish("mask", shared_inputs["mask"])
+    binner = shared_inputs["binner"]
+    if binner is not None:
+        for f in RING_INDEX_FIELDS:
+            shared.publish(f, getattr(binner, f))
+    return
+
+
+def _init_worker(poni_file: str, specs: dict, bg_key: str = None) -> None:
+    """Initialize the worker of the parallel integration with the shared inputs."""
+    arrays = attach_arrays(specs)
+    if all(f in arrays for f in RING_INDEX_FIELDS):
+        binner = RingIndex(*(arrays.pop(f) for f in RING_INDEX_FIELDS))
+    else:
+        binner = None
+    # pyFAI does not take the read only buffers so the shared mask is copied once in the worker
+    mask = arrays["mask"]
+    if mask is not None:
+        mask = mask.copy()
+    _SHARED_INPUTS.update(
+        ai=io.load_ai_from_poni_file(poni_file),
+        bg_img=arrays["bg_img"],
+        bg_key=bg_key,
+        mask=mask,
+        binner=binner,
+    )
+    return
+
+
+def _integrate_in_worker(img_file: str, **kwargs) -> str:
+    """Integrate the image file in a worker with the shared inputs."""
+    return _integrate(img_file, **_SHARED_INPUTS, **kwargs)
 
 
 def _integrate(
-    poni_file: str,
     img_file: str,
-    bg_img_file: str = None,
-    mask_file: str = None,
+    ai: AzimuthalIntegrator,
+    img: ndarray = None,
+    bg_img: ndarray = None,
+    bg_key: str = None,
+    mask: ndarray = None,
+    binner: RingIndex = None,
     output_dir: str = ".",
     bg_scale: float = None,
     mask_setting: tp.Union[dict, str] = None,
     integ_setting: dict = None,
     plot_setting: tp.Union[dict, str] = None,
     img_setting: tp.Union[dict, str] = None,
+    dtype: str = None,
+    use_matrix: bool = False,
+    bg_mode: str = "2d",
     test: bool = False,
 ) -> str:
-    """Sub-function for integrate."""
-    if integ_setting is None:
-        integ_setting = dict()
-    ai = io.load_ai_from_poni_file(poni_file)
-    bg_img = io.load_img(bg_img_file) if bg_img_file else None
-    mask = np.load(mask_file) if mask_file else None
-    img = io.load_img(img_file)
+    """Sub-function for integrate. The image is read from the file if it is not given."""
+    integ_setting = dict(integ_setting) if integ_setting else dict()
+    if img is None:
+        img = io.load_img(img_file)
+    if binner is not None and binner.q.shape != img.shape:
+        binner = None
     chi_name = Path(img_file).with_suffix(".chi").name
     chi_path = Path(output_dir).joinpath(chi_name)
     integ_setting.update({"filename": str(chi_path)})
@@ -158,13 +276,140 @@ def _integrate(
         integ_setting=integ_setting,
         plot_setting=plot_setting,
         img_setting=img_setting,
+        dtype=dtype,
+        use_matrix=use_matrix,
+        bg_mode=bg_mode,
+        binner=binner,
+        bg_key=bg_key,
     )
     if not test:
         plt.show()
     return chi_path
 
 
-def average(out_file: str, *img_files, weights: tp.List[float] = None) -> None:
+def watch(
+    poni_file: str,
+    directory: str,
+    bg_img_file: str = None,
+    mask_file: str = None,
+    output_dir: str = None,
+    pattern: str = "*.tiff",
+    bg_scale: float = None,
+    mask_setting: tp.Union[dict, str] = None,
+    integ_setting: dict = None,
+    dtype: str = None,
+    use_matrix: bool = False,
+    bg_mode: str = "2d",
+    settle_time: float = 1.0,
+    poll: bool = False,
+    poll_interval: float = 1.0,
+    manifest_file: str = None,
+    timeout: float = None,
+) -> tp.List[str]:
+    """Integrate the diffraction images landing in a directory as they are completed.
+
+    The geometry, background image and mask are loaded once. The images already in the directory and the new ones
+    are integrated in the same way as the `integrate` without the visualization. The directory is watched by the
+    inotify on Linux or scanned periodically on the other platforms. An image is integrated when its size and
+    modification time have not changed for `settle_time` seconds so that the partially written files are skipped.
+    The images done are recorded in a manifest file so that they are not integrated again after a restart. Stop
+    it by Ctrl-C or by the `timeout`.
+
+    Parameters
+    ----------
+    poni_file : str
+        The path to the poni file. It will be read by pyFAI.
+
+    directory : str
+        The directory to watch.
+
+    bg_img_file, mask_file, bg_scale, mask_setting, integ_setting, dtype, use_matrix, bg_mode :
+        The same as those in the `integrate`.
+
+    output_dir : str
+        The directory to save the chi data file. If None, use the watched directory.
+
+    pattern : str
+        The glob pattern of the image file names. Default "*.tiff".
+
+    settle_time : float
+        The seconds that an image file must stay unchanged before it is integrated.
+
+    poll : bool
+        If True, scan the directory instead of using the inotify. Use it on the network file systems where the
+        files are written by another machine.
+
+    poll_interval : float
+        The seconds between the scans of the directory.
+
+    manifest_file : str
+        The path to the manifest of the images done. If None, it is ".pdfstream_manifest.jsonl" in the output
+        directory.
+
+    timeout : float
+        The seconds to wait for a new image before stopping. If None, watch until interrupted.
+
+    Returns
+    -------
+    chi_files : a list of strings
+        The path to the output chi files written in this run.
+    """
+    output_dir = output_dir if output_dir is not None else directory
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    if manifest_file is None:
+        manifest_file = Path(output_dir).joinpath(".pdfstream_manifest.jsonl")
+    manifest = Manifest(manifest_file)
+    kwargs = dict(
+        output_dir=output_dir,
+        bg_scale=bg_scale,
+        mask_setting=mask_setting,
+        integ_setting=integ_setting,
+        plot_setting="OFF",
+        img_setting="OFF",
+        dtype=dtype,
+        use_matrix=use_matrix,
+        bg_mode=bg_mode,
+        test=True,
+    )
+    shared_inputs = _load_shared_inputs(poni_file, bg_img_file, mask_file, dtype)
+    watcher = DirectoryWatcher(
+        directory,
+        pattern=pattern,
+        settle_time=settle_time,
+        poll_interval=poll_interval,
+        poll=poll,
+        timeout=timeout,
+        seen=manifest.states,
+    )
+    chi_files = []
+    try:
+        for img_file in watcher:
+            try:
+                state = file_state(img_file)
+                img = io.load_img(str(img_file))
+                _set_binner(shared_inputs, img, mask_setting)
+                chi_file = _integrate(str(img_file), img=img, **shared_inputs, **kwargs)
+            except Exception as error:
+                # a broken file does not stop the watching, it is tried again after a restart
+                io.server_message("Failed to integrate {}: {}".format(img_file, error))
+                continue
+            manifest.record(img_file.name, state, str(chi_file))
+            chi_files.append(str(chi_file))
+            io.server_message("Integrated {} to {}.".format(img_file, chi_file))
+    except KeyboardInterrupt:
+        pass
+    return chi_files
+
+
+def average(
+    out_file: str,
+    *img_files,
+    weights: tp.List[float] = None,
+    method: str = "mean",
+    sigma: float = 3.0,
+    prefetch: int = 4,
+    prefetch_threads: int = 2
+) -> None:
     """Average the single channel image files with weights.
 
     Parameters
@@ -176,11 +421,36 @@ def average(out_file: str, *img_files, weights: tp.List[float] = None) -> None:
         The image files to be averaged.
 
     weights : an iterable of floats
-        The weights for the images. If None, images will not be weighted when averaged.
+        The weights for the images. If None, images will not be weighted when averaged. Only used in the "mean"
+        method.
+
+    method : str
+        "mean", "median" or "sigma_clip". The "median" and "sigma_clip" reject the cosmic rays and zingers. The
+        "sigma_clip" takes the mean of the values within sigma times the standard deviation from the median
+        iteratively. They read the rows of the uncompressed tiff files tile by tile and keep the other images in
+        the memory while the "mean" only keeps one.
+
+    sigma : float
+        The threshold of the "sigma_clip" method.
+
+    prefetch : int
+        The maximum number of the images read ahead in the background threads in the "mean" method. If 0, the
+        images are read one by one.
+
+    prefetch_threads : int
+        The number of the threads to read the images ahead.
     """
     img_files: tp.Tuple[str]
-    imgs = (io.load_img(_) for _ in img_files)
-    avg_img = integ.avg_imgs(imgs, weights=weights)
+    if method == "mean":
+        reader = PrefetchReader(img_files, depth=prefetch, threads=prefetch_threads)
+        avg_img = integ.avg_imgs((img for _, img in reader), weights=weights, method=method)
+        reader.report()
+    else:
+        imgs = [io.LazyImage(f) for f in img_files]
+        if method == "sigma_clip":
+            avg_img = integ.avg_imgs(imgs, weights=weights, method=method, sigma=sigma)
+        else:
+            avg_img = integ.avg_imgs(imgs, weights=weights, method=method)
     # make the directory if not exists
     out_file_path = Path(out_file)
     if not out_file_path.parent.is_dir():
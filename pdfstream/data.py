@@ -4,4 +4,6 @@ from pathlib import Path
 from pkg_resources import resource_filename
 
 ni_dspacing_file = Path(resource_filename("pdfstream", "data/Ni_dspacing.txt"))
+config_dir = Path("~/.config/pdfstream/").expanduser()
+cache_dir = config_dir.joinpath("cache")
 QUIET = False
@@ -0,0 +1,174 @@
+"""The cache of the arrays parsed from the text data files.
+
+It does not import the masking so that `pdfstream.io.load_array` stays light.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import typing as T
+from pathlib import Path
+
+import numpy as np
+
+import pdfstream.data
+from pdfstream.vend.loaddata import load_data
+
+DATA_CACHE_VERSION = "data-file-v1"
+# the environment variable to enable the data file cache: "sidecar" or a directory
+DATA_CACHE_ENV = "PDFSTREAM_DATA_CACHE"
+
+
+class DataFileCache:
+    """The cache of the arrays parsed from the text data files saved as .npy files.
+
+    The key of a data file is the hash of its absolute path, modification
+    time, size and the arguments of the parsing. It is checked at every load
+    so that a modified file is parsed again. The cached arrays are loaded in
+    the memory so that they are the same writable arrays as the parsed ones.
+
+    Parameters
+    ----------
+    directory : str or Path, optional
+        The directory of the cached arrays. If None, the array is saved as a
+        hidden sidecar file next to the data file.
+    max_bytes : int
+        The maximum total size of the arrays in the directory. The least
+        recently used ones are removed when it is exceeded. Not used for the
+        sidecar files, which are one per data file.
+    enabled : bool
+        If False, the data files are always parsed and nothing is saved.
+    """
+
+    def __init__(
+        self,
+        directory: T.Union[None, str, Path] = None,
+        max_bytes: int = 2 ** 30,
+        enabled: bool = True,
+    ):
+        self.directory = Path(directory).expanduser() if directory else None
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, data_file: T.Union[str, Path], **kwargs) -> str:
+        """The key of the data file in its current state and the arguments of the parsing."""
+        path = Path(data_file).resolve()
+        st = path.stat()
+        state = [DATA_CACHE_VERSION, str(path), st.st_mtime_ns, st.st_size, kwargs]
+        return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+    def cache_file(self, data_file: T.Union[str, Path], key: str) -> Path:
+        """The path of the cached array."""
+        if self.directory is not None:
+            return self.directory.joinpath(key + ".npy")
+        path = Path(data_file)
+        return path.with_name(".{}.{}.npy".format(path.name, key[:16]))
+
+    def load(self, data_file: T.Union[str, Path], minrows: int = 10, **kwargs) -> np.ndarray:
+        """Load the array of the columns in the rows like `pdfstream.io.load_array`."""
+        if not self.enabled:
+            return load_data(data_file, minrows=minrows, **kwargs).T
+        key = self.key(data_file, minrows=minrows, **kwargs)
+        cache_file = self.cache_file(data_file, key)
+        try:
+            array = np.load(cache_file)
+        except (OSError, ValueError):
+            array = None
+        if array is not None:
+            self.hits += 1
+            # record the use for the eviction
+            try:
+                os.utime(cache_file)
+            except OSError:
+                pass
+            return array
+        self.misses += 1
+        array = load_data(data_file, minrows=minrows, **kwargs).T
+        self._save(data_file, cache_file, array)
+        return array
+
+    def clear(self) -> None:
+        """Remove all the arrays in the directory and reset the counters."""
+        if self.directory is not None and self.directory.is_dir():
+            for f in self.directory.glob("*.npy"):
+                f.unlink()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def _save(self, data_file: T.Union[str, Path], cache_file: Path, array: np.ndarray) -> None:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # write a temporary file first so that other processes never read a half written array
+            fd, temp_file = tempfile.mkstemp(dir=cache_file.parent, prefix=".tmp-", suffix=".npy")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, array)
+                os.replace(temp_file, cache_file)
+            finally:
+                if os.path.exists(temp_file):
+                    os.unlink(temp_file)
+        except OSError:
+            # like a read only directory
+            return
+        if self.directory is None:
+            self._remove_stale_sidecars(Path(data_file), cache_file)
+        else:
+            self._evict()
+        return
+
+    @staticmethod
+    def _remove_stale_sidecars(data_file: Path, cache_file: Path) -> None:
+        for f in data_file.parent.glob(".{}.*.npy".format(data_file.name)):
+            if f != cache_file:
+                try:
+                    f.unlink()
+                except OSError:
+                    pass
+        return
+
+    def _evict(self) -> None:
+        files = []
+        for f in self.directory.glob("*.npy"):
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, f))
+        total = sum(size for _, size, _ in files)
+        files.sort()
+        for _, size, f in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                f.unlink()
+            except OSError:
+                pass
+            total -= size
+        return
+
+
+def _data_cache_from_env() -> DataFileCache:
+    value = os.environ.get(DATA_CACHE_ENV, "").strip()
+    if value.lower() in ("", "0", "off", "false", "no"):
+        return DataFileCache(enabled=False)
+    if value.lower() in ("1", "on", "true", "yes"):
+        return DataFileCache(pdfstream.data.cache_dir.joinpath("data"))
+    if value.lower() == "sidecar":
+        return DataFileCache()
+    return DataFileCache(value)
+
+
+_DATA_CACHE = _data_cache_from_env()
+
+
+def get_data_cache() -> DataFileCache:
+    """The data file cache used by `pdfstream.io.load_array` in the process.
+
+    It is disabled unless the environment variable PDFSTREAM_DATA_CACHE is
+    "sidecar" for the sidecar files, "1" for the default cache directory or
+    the path to a cache directory. Set its attributes to change it.
+    """
+    return _DATA_CACHE
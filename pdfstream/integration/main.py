@@ -4,7 +4,19 @@ import numpy as np
 from numpy import ndarray
 from pyFAI import AzimuthalIntegrator
 
-from pdfstream.integration.tools import bg_sub, vis_img, integrate, vis_chi, auto_mask
+from pdfstream.integration.tools import (
+    WeightedMean,
+    as_compute_dtype,
+    auto_mask,
+    integrate,
+    integrate_bg,
+    robust_avg_imgs,
+    save_chi,
+    sub_dtype,
+    sub_images,
+    vis_chi,
+    vis_img,
+)
 
 
 def get_chi(
@@ -18,6 +30,11 @@ def get_chi(
     integ_setting: dict = None,
     img_setting: tp.Union[str, dict] = None,
     plot_setting: tp.Union[str, dict] = None,
+    dtype: str = None,
+    use_matrix: bool = False,
+    bg_mode: str = "2d",
+    binner=None,
+    bg_key: str = None,
 ) -> tp.Tuple[
     ndarray,
     ndarray,
@@ -69,13 +86,37 @@ def get_chi(
     plot_setting : dict
         The kwargs for the plot function. If None, use empty dict.
 
+    dtype : str
+        The data type of the computation, like "float32". The images are converted to it once at the beginning
+        and the subtraction, masking and integration all run in it. If None, the images are not converted and
+        the integer images are promoted to float64 in the subtraction.
+
+    use_matrix : bool
+        If True, integrate by the sparse integration matrix cached for the geometry, mask and integration setting.
+        It is faster when the mask is the same for the images, like a user mask without the auto masking.
+
+    bg_mode : str
+        How the background is subtracted. "2d" subtracts the scaled background image from the image before the
+        masking and integration. "1d" integrates the background once for the mask and settings, keeps it and
+        subtracts the scaled curve from the integrated image, so there is no 2D work on the background per image.
+        Both give the same results when the mask is the same. With the auto masking, the mask in "1d" is
+        calculated from the image without the background subtraction and may differ from the "2d" one.
+
+    binner : BinnedStatistic1D or RingIndex
+        The pixels sorted by the rings used in the auto masking. If None, it is created from the ai for the image.
+
+    bg_key : str
+        The key of the background image for the integrated background kept in "1d" bg_mode, see `integrate_bg`.
+        If None, it is hashed from the background image for each image.
+
     Returns
     -------
     chi : ndarray
         The 2D array of integrated results. The first row is the Q and the second row is the I.
 
     bg_sub_img : ndarray
-        The background subtracted image. If no background subtraction, it is the dk_sub_image.
+        The background subtracted image. If no background subtraction or the bg_mode is "1d", it is the
+        dk_sub_image.
 
     dk_sub_img : ndarray
         The dark subtracted image. If no dark subtraction, it is the input img.
@@ -92,17 +133,26 @@ def get_chi(
     _mask_setting : dict or str
         The auto masking setting.
     """
-    if dk_img is not None:
-        dk_sub_img = bg_sub(img, dk_img, bg_scale=1.0)
-    else:
+    img = as_compute_dtype(img, dtype)
+    dk_img = as_compute_dtype(dk_img, dtype)
+    bg_img = as_compute_dtype(bg_img, dtype)
+    if bg_mode not in ("2d", "1d"):
+        raise ValueError("Unknown bg_mode: {}. Use '2d' or '1d'.".format(bg_mode))
+    sub_bg_img = bg_img if bg_mode == "2d" else None
+    if dk_img is not None and sub_bg_img is not None:
+        # subtract the dark and background in one pass and keep the dark subtracted image
+        dk_sub_img = np.empty(img.shape, dtype=sub_dtype(img, dk_img, sub_bg_img))
+        bg_sub_img = sub_images(img, dk_img, sub_bg_img, bg_scale=bg_scale, dk_out=dk_sub_img)
+    elif dk_img is not None:
+        dk_sub_img = bg_sub_img = sub_images(img, dk_img)
+    elif sub_bg_img is not None:
         dk_sub_img = img
-    if bg_img is not None:
-        bg_sub_img = bg_sub(dk_sub_img, bg_img, bg_scale=bg_scale)
+        bg_sub_img = sub_images(img, bg_img=sub_bg_img, bg_scale=bg_scale)
     else:
-        bg_sub_img = dk_sub_img
+        dk_sub_img = bg_sub_img = img
     if mask_setting != "OFF":
         final_mask, _mask_setting = auto_mask(
-            bg_sub_img, ai, user_mask=mask, mask_setting=mask_setting
+            bg_sub_img, ai, user_mask=mask, mask_setting=mask_setting, binner=binner
         )
     elif mask is not None:
         final_mask, _mask_setting = mask, {}
@@ -110,28 +160,78 @@ def get_chi(
         final_mask, _mask_setting = None, None
     if img_setting != "OFF":
         vis_img(bg_sub_img, final_mask, img_setting=img_setting)
-    chi, _integ_setting = integrate(
-        bg_sub_img, ai, mask=final_mask, integ_setting=integ_setting
-    )
+    if bg_img is not None and bg_mode == "1d":
+        # the integration is linear so the background is subtracted after it
+        setting = dict(integ_setting) if integ_setting else {}
+        filename = setting.pop("filename", None)
+        chi, _integ_setting = integrate(
+            bg_sub_img, ai, mask=final_mask, integ_setting=setting, use_matrix=use_matrix
+        )
+        bg_chi, _ = integrate_bg(
+            bg_img, ai, mask=final_mask, integ_setting=setting, use_matrix=use_matrix, bg_key=bg_key
+        )
+        chi[1] -= (1.0 if bg_scale is None else bg_scale) * bg_chi[1]
+        if filename:
+            save_chi(filename, chi[0], chi[1], ai, final_mask, _integ_setting)
+            _integ_setting["filename"] = filename
+    else:
+        chi, _integ_setting = integrate(
+            bg_sub_img, ai, mask=final_mask, integ_setting=integ_setting, use_matrix=use_matrix
+        )
     if plot_setting != "OFF":
         vis_chi(chi, plot_setting=plot_setting, unit=_integ_setting.get("unit"))
     return chi, bg_sub_img, dk_sub_img, img, final_mask, _integ_setting, _mask_setting
 
 
-def avg_imgs(imgs: tp.Iterable[ndarray], weights: tp.Iterable[float] = None) -> ndarray:
+def avg_imgs(
+    imgs: tp.Iterable[ndarray],
+    weights: tp.Iterable[float] = None,
+    method: str = "mean",
+    **kwargs
+) -> ndarray:
     """Average the 2D images.
 
+    In the "mean" method, the images are consumed one by one and accumulated in float64 so that the memory does
+    not grow with the number of the images. A generator of the images can be used. The "median" and
+    "sigma_clip" methods are robust to the cosmic rays and zingers. They reduce the images tile by tile in the
+    threads. The arrays are all kept in the memory while the `pdfstream.io.LazyImage` of the files are read
+    tile by tile. See `robust_avg_imgs`.
+
     Parameters
     ----------
     imgs : ndarray
-        The 2D array of diffraction images.
+        The 2D array of diffraction images. The "median" and "sigma_clip" methods also take the
+        `pdfstream.io.LazyImage`.
 
     weights : an iterable of floats
-        The weights for the images. If None, images will not be weighted when averaged.
+        The weights for the images. If None, images will not be weighted when averaged. Only used in the "mean"
+        method.
+
+    method : str
+        "mean", "median" or "sigma_clip".
+
+    kwargs :
+        The keyword arguments of the `robust_avg_imgs`, like sigma, maxiters, tile_size and threads.
 
     Returns
     -------
     avg_img : ndarray
         The averaged 2D image array.
     """
-    return np.average(np.stack(tuple(imgs), axis=0), axis=0, weights=weights)
+    if method != "mean":
+        if weights is not None:
+            raise ValueError("The weights are only used in the 'mean' method.")
+        return robust_avg_imgs(imgs, method=method, **kwargs)
+    acc = WeightedMean()
+    if weights is None:
+        for img in imgs:
+            acc.add(img)
+        return acc.mean()
+    weights = list(weights)
+    for img in imgs:
+        if acc.count >= len(weights):
+            raise ValueError("Length of weights not compatible with the number of images.")
+        acc.add(img, weights[acc.count])
+    if acc.count != len(weights):
+        raise ValueError("Length of weights not compatible with the number of images.")
+    return acc.mean()
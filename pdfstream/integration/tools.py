@@ -1,6 +1,10 @@
 """The functions used in the integration pipelines. All functions consume namespace and return the modified
 namespace. """
-from typing import Tuple
+import functools
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Tuple, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -8,8 +12,15 @@ from matplotlib.axes import Axes
 from numpy import ndarray
 from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
 
-from pdfstream.vend.masking import generate_binner, mask_img
+from pdfstream.cache import hash_key
+from pdfstream.integration.sparse import get_integration_matrix, save_chi, sparse_method
+from pdfstream.io import LazyImage, pack_mask
+from pdfstream.vend.jittools import median_frames, sigma_clip_frames, subtract_images
+from pdfstream.vend.masking import generate_binner, mask_img, mask_stack
 
+# the number of the integrated backgrounds kept in the memory
+BG_CHI_CACHE_SIZE = 8
+_BG_CHI_CACHE = OrderedDict()
 INTEG_SETTING = dict(
     npt=1480, correctSolidAngle=False, method="splitpixel", unit="q_A^-1", safe=False
 )
@@ -37,13 +48,247 @@ def bg_sub(img: ndarray, bg_img: ndarray, bg_scale: float = None) -> ndarray:
     bg_scale : float
         The scale of the the background image.
     """
+    return sub_images(img, bg_img=bg_img, bg_scale=bg_scale)
+
+
+def sub_dtype(*imgs: ndarray) -> np.dtype:
+    """The data type of the subtraction of the images, that of the images if they are all float, otherwise
+    float64."""
+    if all(x.dtype.kind == "f" for x in imgs):
+        return np.result_type(*imgs)
+    return np.dtype(np.float64)
+
+
+def sub_images(
+    img: ndarray,
+    dk_img: ndarray = None,
+    bg_img: ndarray = None,
+    bg_scale: float = None,
+    lower: float = None,
+    out: ndarray = None,
+    dk_out: ndarray = None,
+) -> ndarray:
+    """Subtract the dark image and the scaled background image and clip the result in one pass.
+
+    The result is ``img - dk_img - bg_scale * bg_img`` clipped at the lower limit. It is computed pixel by pixel
+    in float64 by a numba kernel without any temporary array.
+
+    Parameters
+    ----------
+    img : ndarray
+        The 2D diffraction image array.
+
+    dk_img : ndarray
+        The 2D dark image array. If None, no dark subtraction.
+
+    bg_img : ndarray
+        The 2D background image array. If None, no background subtraction.
+
+    bg_scale : float
+        The scale of the the background image. If None, use 1.0.
+
+    lower : float
+        The lower limit of the result. If None, the result is not clipped.
+
+    out : ndarray
+        The C contiguous output array, which can be reused for the images of the same shape. If None, a new
+        array is created in the data type given by `sub_dtype`.
+
+    dk_out : ndarray
+        The C contiguous output array of the dark subtracted image ``img - dk_img``. If None, it is not kept.
+
+    Returns
+    -------
+    out : ndarray
+        The subtracted image.
+    """
     if bg_scale is None:
         bg_scale = 1.0
-    if bg_img.shape != img.shape:
-        raise ValueError(
-            f"Unmatched shape between two images: {bg_img.shape}, {img.shape}."
-        )
-    return img - bg_scale * bg_img
+    img = np.asarray(img)
+    dk_img = np.asarray(dk_img) if dk_img is not None else None
+    bg_img = np.asarray(bg_img) if bg_img is not None else None
+    imgs = [x for x in (img, dk_img, bg_img) if x is not None]
+    for x in imgs[1:]:
+        if x.shape != img.shape:
+            raise ValueError(
+                f"Unmatched shape between two images: {x.shape}, {img.shape}."
+            )
+    if out is None:
+        out = np.empty(img.shape, dtype=sub_dtype(*imgs))
+    for x in (out, dk_out):
+        if x is not None and (x.shape != img.shape or not x.flags.c_contiguous):
+            raise ValueError(
+                "The output array must be C contiguous in the shape {}.".format(img.shape)
+            )
+    subtract_images(
+        np.ravel(img),
+        np.ravel(dk_img) if dk_img is not None else None,
+        np.ravel(bg_img) if bg_img is not None else None,
+        float(bg_scale),
+        float(lower) if lower is not None else None,
+        out.reshape(-1),
+        dk_out.reshape(-1) if dk_out is not None else None,
+    )
+    return out
+
+
+def as_compute_dtype(img: ndarray, dtype: str = None) -> ndarray:
+    """Convert the image to the data type used in the computation.
+
+    The image is not copied if it is already in the data type. If the image or the dtype is None, the image is
+    returned as it is.
+
+    Parameters
+    ----------
+    img : ndarray
+        The image array.
+
+    dtype : str
+        The data type, like "float32".
+
+    Returns
+    -------
+    img : ndarray
+        The image in the data type.
+    """
+    if img is None or dtype is None:
+        return img
+    return np.asarray(img, dtype=dtype)
+
+
+class WeightedMean:
+    """The running weighted mean of the images added one by one.
+
+    The weighted sum is accumulated in float64 so that only the sum and a buffer of the size of one image are in
+    the memory whatever the number of the images.
+
+    Examples
+    --------
+    >>> acc = WeightedMean()
+    >>> for img in imgs:
+    ...     acc.add(img)
+    >>> avg_img = acc.mean()
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.weight_sum = 0.0
+        self.dtype = None
+        self._sum = None
+        self._buffer = None
+
+    def add(self, img: ndarray, weight: float = None) -> None:
+        """Add an image with a weight. If the weight is None, the image is not weighted."""
+        img = np.asarray(img)
+        if self._sum is None:
+            self._sum = np.zeros(img.shape, dtype=np.float64)
+            self.dtype = img.dtype
+        elif img.shape != self._sum.shape:
+            raise ValueError(
+                "Unmatched shape of the image: {}, {}.".format(img.shape, self._sum.shape)
+            )
+        if weight is None:
+            np.add(self._sum, img, out=self._sum)
+            self.weight_sum += 1.0
+        else:
+            if self._buffer is None:
+                self._buffer = np.empty_like(self._sum)
+            np.multiply(img, weight, out=self._buffer)
+            np.add(self._sum, self._buffer, out=self._sum)
+            self.weight_sum += weight
+            self.dtype = np.result_type(self.dtype, np.asarray(weight).dtype)
+        self.count += 1
+        return
+
+    def mean(self) -> ndarray:
+        """The weighted mean in the data type of the images or float64 if the images are integers."""
+        if self._sum is None:
+            raise ValueError("No image to average.")
+        if self.weight_sum == 0.0:
+            raise ZeroDivisionError("Weights sum to zero, can't be normalized.")
+        dtype = self.dtype if self.dtype.kind == "f" else np.float64
+        return (self._sum / self.weight_sum).astype(dtype, copy=False)
+
+
+ROBUST_METHODS = ("median", "sigma_clip")
+
+
+def robust_avg_imgs(
+    imgs: Iterable[ndarray],
+    method: str = "median",
+    sigma: float = 3.0,
+    maxiters: int = 5,
+    tile_size: int = 2 ** 22,
+    threads: int = None,
+) -> ndarray:
+    """Average the images by the median or the sigma clipped mean at each pixel.
+
+    The images are split into tiles of rows. The values of a tile in all the images are gathered and reduced by
+    a numba kernel, so the extra memory is about the tile size times the number of the threads instead of
+    several copies of the whole stack. The tiles are processed in parallel by the threads. With the
+    `pdfstream.io.LazyImage` of the files, only the rows of the tiles in use are read from the files.
+
+    Parameters
+    ----------
+    imgs : Iterable[ndarray or LazyImage]
+        The 2D images. The arrays are all kept in the memory while the `LazyImage` are read tile by tile.
+
+    method : str
+        "median" or "sigma_clip". The "sigma_clip" rejects the values farther than `sigma` times the standard
+        deviation from the median iteratively and takes the mean of the rest.
+
+    sigma : float
+        The threshold of the sigma clipping.
+
+    maxiters : int
+        The maximum number of the iterations of the sigma clipping.
+
+    tile_size : int
+        The maximum number of the values in a tile, which is the number of the images times the pixels in the
+        rows of the tile. A tile has at least one row.
+
+    threads : int
+        The number of the threads. If None, use the number of the CPUs.
+
+    Returns
+    -------
+    avg_img : ndarray
+        The averaged image in the data type of the images or float64 if the images are integers.
+    """
+    if method not in ROBUST_METHODS:
+        raise ValueError("Unknown method '{}'. Use one of {}.".format(method, ROBUST_METHODS))
+    imgs = [img if isinstance(img, LazyImage) else np.asarray(img) for img in imgs]
+    if not imgs:
+        raise ValueError("No image to average.")
+    shape = imgs[0].shape
+    for img in imgs:
+        if img.shape != shape:
+            raise ValueError("Unmatched shape of the image: {}, {}.".format(img.shape, shape))
+    n_rows = shape[0]
+    row_size = int(np.prod(shape[1:]))
+    step = max(tile_size // max(len(imgs) * row_size, 1), 1)
+    out = np.empty((n_rows, row_size), dtype=np.float64)
+    dtype = functools.reduce(np.promote_types, [img.dtype for img in imgs])
+
+    def reduce_tile(start: int) -> None:
+        stop = min(start + step, n_rows)
+        tile = np.empty((len(imgs), stop - start, row_size), dtype=dtype)
+        for k, img in enumerate(imgs):
+            tile[k] = img[start:stop].reshape(stop - start, row_size)
+        tile = tile.reshape(len(imgs), -1)
+        tile_out = out[start:stop].reshape(-1)
+        if method == "median":
+            median_frames(tile, tile_out)
+        else:
+            sigma_clip_frames(tile, sigma, maxiters, tile_out)
+        return
+
+    threads = threads if threads else os.cpu_count()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # raise the errors in the threads
+        list(executor.map(reduce_tile, range(0, n_rows, step)))
+    out = out.reshape(shape)
+    return out.astype(dtype if dtype.kind == "f" else np.float64, copy=False)
 
 
 def integrate(
@@ -51,6 +296,7 @@ def integrate(
     ai: AzimuthalIntegrator,
     mask: ndarray = None,
     integ_setting: dict = None,
+    use_matrix: bool = False,
 ) -> Tuple[ndarray, dict]:
     """Use AzimuthalIntegrator to integrate the image.
 
@@ -68,6 +314,10 @@ def integrate(
     integ_setting : dict
         The user's modification to integration settings.
 
+    use_matrix : bool
+        If True, integrate the image by the sparse integration matrix in the shared cache. It is built for the
+        first image of a geometry, mask and setting and reused for the following ones.
+
     Returns
     -------
     chi : ndarray
@@ -81,11 +331,181 @@ def integrate(
     if integ_setting is not None:
         _integ_setting.update(integ_setting)
     # integrate
+    if use_matrix:
+        matrix = get_integration_matrix(ai, np.shape(img), mask, _integ_setting)
+        chi = np.stack([matrix.x, matrix.integrate(img)])
+        filename = _integ_setting.get("filename")
+        if filename:
+            save_chi(filename, chi[0], chi[1], ai, mask, _integ_setting)
+        return chi, _integ_setting
     xy = ai.integrate1d(img, mask=mask, **_integ_setting)
     chi = np.stack(xy)
     return chi, _integ_setting
 
 
+def bg_file_key(bg_file: str, dtype: str = None) -> str:
+    """The key of the background image loaded from a file in the data type for `integrate_bg`.
+
+    It is made of the path, size and modification time of the file so that the image is not hashed.
+
+    Parameters
+    ----------
+    bg_file : str
+        The path to the background image file.
+
+    dtype : str
+        The data type that the image is converted to, like "float32".
+
+    Returns
+    -------
+    key : str
+        The hex string key.
+    """
+    st = os.stat(bg_file)
+    return hash_key(os.path.abspath(bg_file), st.st_size, st.st_mtime_ns, dtype)
+
+
+def integrate_bg(
+    bg_img: ndarray,
+    ai: AzimuthalIntegrator,
+    mask: ndarray = None,
+    integ_setting: dict = None,
+    use_matrix: bool = False,
+    bg_key: str = None,
+) -> Tuple[ndarray, dict]:
+    """Integrate the background image and keep the result for the same background, geometry, mask and setting.
+
+    The 'filename' in the integ_setting is ignored so that the background is never saved.
+
+    Parameters
+    ----------
+    bg_img : ndarray
+        The 2D background image array.
+
+    ai : AzimuthalIntegrator
+        The AzimuthalIntegrator instance.
+
+    mask : ndarray
+        The mask as a 0 and 1 array. 0 pixels are good pixels, 1 pixels are masked out.
+
+    integ_setting : dict
+        The user's modification to integration settings.
+
+    use_matrix : bool
+        If True, integrate the image by the sparse integration matrix in the shared cache.
+
+    bg_key : str
+        The key of the background image computed once when it is loaded, like the `bg_file_key` of its file. If
+        None, the key is hashed from the whole image in every call, which costs more than the 2D subtraction.
+
+    Returns
+    -------
+    chi : ndarray
+        The read only chi data of the background.
+
+    _integ_setting: dict
+        The whole integration setting.
+    """
+    setting = {k: v for k, v in (integ_setting or {}).items() if k != "filename"}
+    if bg_key is None:
+        bg_key = hash_key(bg_img)
+    key = hash_key(
+        bg_key,
+        ai.get_config(),
+        pack_mask(mask) if mask is not None else None,
+        setting,
+        use_matrix,
+    )
+    if key in _BG_CHI_CACHE:
+        _BG_CHI_CACHE.move_to_end(key)
+        return _BG_CHI_CACHE[key]
+    if not bg_img.flags.writeable:
+        # pyFAI does not take the read only buffers, like the shared arrays in the workers
+        bg_img = bg_img.copy()
+    chi, _integ_setting = integrate(
+        bg_img, ai, mask=mask, integ_setting=setting, use_matrix=use_matrix
+    )
+    chi.setflags(write=False)
+    _BG_CHI_CACHE[key] = (chi, _integ_setting)
+    while len(_BG_CHI_CACHE) > BG_CHI_CACHE_SIZE:
+        _BG_CHI_CACHE.popitem(last=False)
+    return chi, _integ_setting
+
+
+def integrate_stack(
+    images: Union[ndarray, Iterable[ndarray]],
+    ai: AzimuthalIntegrator,
+    mask: ndarray = None,
+    integ_setting: dict = None,
+    use_matrix: bool = False,
+) -> Tuple[ndarray, ndarray, dict]:
+    """Integrate a stack of images with the same geometry and mask.
+
+    The sparse matrix integration engine is built for the first frame and applied to all the other frames. The
+    method in the integ_setting is replaced by the CSR one with the same pixel splitting, which gives the same
+    results as the histogram one within the float32 precision.
+
+    Parameters
+    ----------
+    images : ndarray or iterable
+        The 3D array of frames or an iterable of 2D frames of the same shape.
+
+    ai : AzimuthalIntegrator
+        The AzimuthalIntegrator instance.
+
+    mask : ndarray
+        The mask shared by all frames. 0 pixels are good pixels, 1 pixels are masked out.
+
+    integ_setting : dict
+        The user's modification to integration settings.
+
+    use_matrix : bool
+        If True, integrate the frames by the sparse integration matrix in the shared cache. A 3D array is
+        integrated in one sparse dense matrix multiplication.
+
+    Returns
+    -------
+    x : ndarray
+        The bin centers.
+
+    intensity : ndarray
+        The (n_frames, npt) array of the average intensity in bins.
+
+    _integ_setting: dict
+        The whole integration setting with the method used.
+    """
+    _integ_setting = INTEG_SETTING.copy()
+    if integ_setting is not None:
+        _integ_setting.update(integ_setting)
+    _integ_setting["method"] = sparse_method(_integ_setting["method"]).method[1:4]
+    frames = iter(images)
+    first = next(frames, None)
+    if first is None:
+        raise ValueError("No frame in the images.")
+    if use_matrix:
+        matrix = get_integration_matrix(ai, np.shape(first), mask, _integ_setting)
+        if isinstance(images, ndarray) and images.ndim == 3:
+            return matrix.x, matrix.integrate(images), _integ_setting
+        x = matrix.x
+        intensity = [matrix.integrate(first)]
+    else:
+        # the engine is checked against the geometry and mask only once
+        x, y = ai.integrate1d(first, mask=mask, **dict(_integ_setting, safe=True))
+        intensity = [y]
+    for frame in frames:
+        if np.shape(frame) != np.shape(first):
+            raise ValueError(
+                f"Unmatched shape between two frames: {np.shape(frame)}, {np.shape(first)}."
+            )
+        if use_matrix:
+            intensity.append(matrix.integrate(frame))
+        else:
+            intensity.append(
+                ai.integrate1d(frame, mask=mask, **dict(_integ_setting, safe=False))[1]
+            )
+    return x, np.stack(intensity), _integ_setting
+
+
 def vis_img(
     img: ndarray, mask: ndarray = None, img_setting: dict = None, show: bool = True
 ) -> Axes:
@@ -175,6 +595,7 @@ def auto_mask(
     ai: AzimuthalIntegrator,
     user_mask: ndarray = None,
     mask_setting: dict = None,
+    binner=None,
 ) -> Tuple[ndarray, dict]:
     """Automatically generate the mask of the image.
 
@@ -192,10 +613,14 @@ def auto_mask(
     user_mask : ndarray
         A mask provided by user. It is an integer array. 0 are good pixels, 1 are masked out.
 
+    binner : BinnedStatistic1D or RingIndex
+        The pixels sorted by the rings of the geometry and the image shape. If None, it is created from the ai.
+        Pass it to reuse it for many images.
+
     Returns
     -------
     mask : ndarray
-        The mask as an integer array. 0 are good pixels, 1 are masked out.
+        The mask as a bool array. False are good pixels, True are masked out.
 
     _mask_setting : dict
         The whole mask_setting.
@@ -204,8 +629,54 @@ def auto_mask(
         _mask_setting = mask_setting
     else:
         _mask_setting = dict()
-    binner = generate_binner(ai, img.shape)
+    if binner is None:
+        binner = generate_binner(ai, img.shape)
     tmsk = np.invert(user_mask.astype(bool)) if user_mask is not None else None
     mask = mask_img(img, binner, tmsk=tmsk, **_mask_setting)
-    mask = np.invert(mask).astype(int)
+    mask = np.invert(mask)
+    return mask, _mask_setting
+
+
+def auto_mask_stack(
+    stack: ndarray,
+    ai: AzimuthalIntegrator,
+    user_mask: ndarray = None,
+    mask_setting: dict = None,
+) -> Tuple[ndarray, dict]:
+    """Automatically generate the mask of every frame in a stack of images.
+
+    One binner is created for all the frames and the frames are masked together in a parallel compiled kernel.
+    The mask of each frame is the same as the one from `auto_mask`.
+
+    Parameters
+    ----------
+    stack : ndarray
+        The 3D array of the diffraction images.
+
+    ai : AzimuthalIntegrator
+        The AzimuthalIntegrator instance.
+
+    user_mask : ndarray
+        A 2D mask provided by user for all frames. 0 are good pixels, 1 are masked out.
+
+    mask_setting : dict
+        The user's modification to auto-masking settings.
+
+    Returns
+    -------
+    mask : ndarray
+        The 3D mask packed to bits along the rows. Set bits are masked out. Use
+        `pdfstream.io.unpack_mask` with the shape of the stack to unpack it.
+
+    _mask_setting : dict
+        The whole mask_setting.
+    """
+    if mask_setting is not None:
+        _mask_setting = mask_setting
+    else:
+        _mask_setting = dict()
+    binner = generate_binner(ai, stack.shape[1:])
+    tmsk = np.invert(user_mask.astype(bool)) if user_mask is not None else None
+    mask = mask_stack(stack, binner, tmsk=tmsk, **_mask_setting)
+    mask = pack_mask(np.invert(mask))
     return mask, _mask_setting
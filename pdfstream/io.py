@@ -7,10 +7,10 @@ import numpy as np
 import pyFAI
 import yaml
 from numpy import ndarray
-from tifffile import TiffWriter
+from tifffile import TiffFile, TiffWriter
 
 import pdfstream.data
-from pdfstream.vend.loaddata import load_data
+from pdfstream.datacache import get_data_cache
 import logging
 import sys
 
@@ -47,6 +47,58 @@ def load_img(img_file: str) -> ndarray:
     return img
 
 
+class LazyImage:
+    """The 2D image in a file whose rows are read on demand.
+
+    The rows of the uncompressed tiff files are read from the file when they are sliced, so that only the rows
+    in use are in the memory. Other files are loaded as a whole by `load_img`.
+
+    Parameters
+    ----------
+    img_file : str
+        The path to the image file.
+    """
+
+    def __init__(self, img_file: str):
+        self.img_file = img_file
+        self._img = None
+        self._offset = None
+        if Path(img_file).suffix.lower() in (".tif", ".tiff"):
+            with TiffFile(img_file) as tif:
+                page = tif.pages[0]
+                if page.is_memmappable and page.ndim == 2:
+                    self._offset = page.dataoffsets[0]
+                    self._file_dtype = np.dtype(tif.byteorder + page.dtype.char)
+                    self.shape = page.shape
+        if self._offset is None:
+            self._img = load_img(img_file)
+            self.shape = self._img.shape
+            self.dtype = self._img.dtype
+        else:
+            self.dtype = self._file_dtype.newbyteorder("=")
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None) -> ndarray:
+        img = self[:]
+        return img if dtype is None else img.astype(dtype, copy=False)
+
+    def __getitem__(self, key) -> ndarray:
+        if self._img is not None:
+            return self._img[key]
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            return self[:][key]
+        start, stop, _ = key.indices(self.shape[0])
+        n_rows = max(stop - start, 0)
+        rows = np.empty((n_rows, self.shape[1]), dtype=self._file_dtype)
+        with open(self.img_file, "rb") as f:
+            f.seek(self._offset + start * self.shape[1] * self._file_dtype.itemsize)
+            if f.readinto(rows) != rows.nbytes:
+                raise ValueError("The image file {} is truncated.".format(self.img_file))
+        return rows.astype(self.dtype, copy=False)
+
+
 def write_img(filepath: str, img: ndarray, template: str) -> None:
     """Write out the image data as the same type of the template file."""
     temp_img = fabio.open(template)
@@ -61,8 +113,64 @@ def write_tiff(filepath: str, img: ndarray) -> None:
 
 
 def load_array(data_file: str, minrows=10, **kwargs) -> ndarray:
-    """Load data columns from the .txt file and turn columns to rows and return the numpy array."""
-    return load_data(data_file, minrows=minrows, **kwargs).T
+    """Load data columns from the .txt file and turn columns to rows and return the numpy array.
+
+    The array is loaded from the data file cache if it is enabled. See `pdfstream.datacache.get_data_cache`.
+    """
+    return get_data_cache().load(data_file, minrows=minrows, **kwargs)
+
+
+def pack_mask(mask: ndarray) -> ndarray:
+    """Pack the 2D mask to bits along the rows.
+
+    The nonzero pixels are set bits. Return the uint8 array of shape (rows, ceil(columns / 8)).
+    """
+    return np.packbits(np.asarray(mask, dtype=bool), axis=-1)
+
+
+def unpack_mask(mask: ndarray, shape: tuple) -> ndarray:
+    """Turn a packed or a legacy mask to a bool mask of the image shape.
+
+    Parameters
+    ----------
+    mask : ndarray
+        The mask packed by `pack_mask` or a legacy mask of any dtype in the shape of the image.
+
+    shape : tuple
+        The shape of the image.
+
+    Returns
+    -------
+    mask : ndarray
+        The bool mask in the shape of the image.
+
+    Raises
+    ------
+    ValueError
+        The mask does not match the shape of the image.
+    """
+    mask = np.asarray(mask)
+    shape = tuple(shape)
+    if mask.shape == shape:
+        return mask.astype(bool, copy=False)
+    packed_shape = shape[:-1] + (-(-shape[-1] // 8),)
+    if mask.dtype == np.uint8 and mask.shape == packed_shape:
+        return np.unpackbits(mask, axis=-1, count=shape[-1]).view(bool)
+    raise ValueError("The mask of shape {} does not match the image shape {}.".format(mask.shape, shape))
+
+
+def save_mask(filepath: str, mask: ndarray) -> None:
+    """Save the mask as bits with its shape in a .npz file."""
+    np.savez(filepath, mask=pack_mask(mask), shape=np.array(mask.shape))
+
+
+def load_mask(mask_file: str) -> ndarray:
+    """Load the mask as a bool array from a .npz file from `save_mask` or a legacy .npy file."""
+    data = np.load(mask_file)
+    if isinstance(data, np.lib.npyio.NpzFile):
+        with data:
+            return unpack_mask(data["mask"], tuple(data["shape"]))
+    return data.astype(bool)
 
 
 def load_dict_from_poni(poni_file: str) -> dict:
@@ -8,6 +8,7 @@ import fire
 import pdfstream.callbacks.ananlysisserver as analysis
 import pdfstream.callbacks.serializationserver as serialization
 import pdfstream.callbacks.visualizationserver as visualization
+from pdfstream.data import config_dir
 
 try:
     import diffpy.pdfgetx
@@ -18,7 +19,7 @@ except ImportError:
     PDFGETX_AVAILABLE = False
     print("Warning: diffpy.pdfgetx is not installed. Some functions may raise errors.")
 
-CONFIG_DIR = str(Path("~/.config/pdfstream/").expanduser())
+CONFIG_DIR = str(config_dir)
 
 
 def main():
@@ -28,6 +29,7 @@ def main():
     COMMANDS = {
         "average": cli.average,
         "integrate": cli.integrate,
+        "watch": cli.watch,
         "waterfall": cli.waterfall,
         "visualize": cli.visualize,
     }
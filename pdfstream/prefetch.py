@@ -0,0 +1,104 @@
+"""Read the image files in the background threads ahead of the computation."""
+import time
+import typing as T
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import pdfstream.io as io
+
+
+class PrefetchReader:
+    """Iterate the files and their data loaded ahead in the background threads.
+
+    The files are loaded in the order of the input by a pool of threads. At most `depth` frames are loaded or
+    being loaded ahead of the one consumed so that the memory is bounded. The decoding of the next frames
+    overlaps with the processing of the current one.
+
+    The reader records the number of the frames ready in the queue when a frame is requested and the time spent
+    waiting for the frames. Use `report` at the end of the batch.
+
+    Parameters
+    ----------
+    files : Iterable
+        The files to load.
+
+    loader : Callable
+        The function to load a file. If None, use `pdfstream.io.load_img`.
+
+    depth : int
+        The maximum number of the frames loaded ahead. If 0, the files are loaded in the consumer thread.
+
+    threads : int
+        The number of the threads to load the files.
+    """
+
+    def __init__(
+        self,
+        files: T.Iterable,
+        loader: T.Callable[[T.Any], T.Any] = None,
+        depth: int = 4,
+        threads: int = 2,
+    ):
+        self.files = files
+        self.loader = loader if loader is not None else io.load_img
+        self.depth = depth
+        self.threads = threads
+        self.frames = 0
+        self.wait_time = 0.0
+        self.queue_depths: T.List[int] = []
+
+    def __iter__(self) -> T.Iterator[T.Tuple[T.Any, T.Any]]:
+        if self.depth <= 0:
+            yield from self._iter_sequential()
+        else:
+            yield from self._iter_prefetch()
+
+    def _iter_sequential(self):
+        for f in self.files:
+            t0 = time.perf_counter()
+            data = self.loader(f)
+            self._record(0, time.perf_counter() - t0)
+            yield f, data
+
+    def _iter_prefetch(self):
+        files = iter(self.files)
+        pending = deque()
+        executor = ThreadPoolExecutor(max(self.threads, 1))
+        try:
+            for f in islice(files, self.depth):
+                pending.append((f, executor.submit(self.loader, f)))
+            while pending:
+                f, future = pending.popleft()
+                ready = int(future.done()) + sum(fu.done() for _, fu in pending)
+                t0 = time.perf_counter()
+                data = future.result()
+                self._record(ready, time.perf_counter() - t0)
+                for g in islice(files, 1):
+                    pending.append((g, executor.submit(self.loader, g)))
+                yield f, data
+        finally:
+            # the consumer may stop early
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _record(self, ready: int, wait: float) -> None:
+        self.frames += 1
+        self.wait_time += wait
+        self.queue_depths.append(ready)
+        return
+
+    def report(self) -> None:
+        """Send the queue depth and the time waiting for the frames to the server message."""
+        if self.frames == 0:
+            return
+        io.server_message(
+            "Prefetch: {} frames, {:.3f} s waiting for frames, queue depth mean {:.1f} max {}.".format(
+                self.frames,
+                self.wait_time,
+                sum(self.queue_depths) / self.frames,
+                max(self.queue_depths),
+            )
+        )
+        return
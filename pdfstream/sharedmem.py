@@ -0,0 +1,121 @@
+"""The read only arrays shared with the worker processes through the shared memory."""
+import atexit
+import typing as T
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# the name of the shared memory block, the shape and the dtype of an array
+ArraySpec = T.Tuple[str, T.Tuple[int, ...], str]
+# the blocks attached in this process, kept open while the views are used
+_ATTACHED: T.List[shared_memory.SharedMemory] = []
+
+
+class SharedArrays:
+    """The registry of the arrays published in the shared memory.
+
+    The arrays are copied once into the shared memory blocks. The specs of the blocks are small and picklable so
+    that they can be sent to the worker processes, which attach read only views of the arrays by
+    `attach_arrays` without any copy.
+
+    The blocks are removed when the registry is closed. Use it as a context manager so that they are also removed
+    when the work is interrupted, like by Ctrl-C. The blocks not closed are removed at the exit of the
+    interpreter.
+
+    Examples
+    --------
+    >>> with SharedArrays() as shared:
+    ...     shared.publish("bg_img", bg_img)
+    ...     with ProcessPoolExecutor(initializer=init, initargs=(shared.specs,)) as executor:
+    ...         ...
+    """
+
+    def __init__(self):
+        self._blocks: T.Dict[str, shared_memory.SharedMemory] = dict()
+        self._specs: T.Dict[str, ArraySpec] = dict()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+        return
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._specs
+
+    @property
+    def specs(self) -> T.Dict[str, ArraySpec]:
+        """The specs of the published arrays to be sent to `attach_arrays`."""
+        return dict(self._specs)
+
+    def publish(self, key: str, array: T.Optional[np.ndarray]) -> None:
+        """Copy the array into a new shared memory block. A None array is published as None."""
+        if key in self._specs:
+            raise KeyError("The array '{}' is already published.".format(key))
+        if array is None:
+            self._specs[key] = None
+            return
+        array = np.asarray(array)
+        # the block cannot be empty
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._blocks[key] = block
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        view[...] = array
+        self._specs[key] = (block.name, array.shape, array.dtype.str)
+        return
+
+    def close(self) -> None:
+        """Close and remove all the shared memory blocks."""
+        for block in self._blocks.values():
+            block.close()
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+        self._blocks.clear()
+        self._specs.clear()
+        atexit.unregister(self.close)
+        return
+
+
+def attach_arrays(specs: T.Mapping[str, T.Optional[ArraySpec]]) -> T.Dict[str, T.Optional[np.ndarray]]:
+    """Attach the read only views of the arrays published by a `SharedArrays`.
+
+    The blocks stay attached until `detach_arrays` is called in the process.
+
+    Parameters
+    ----------
+    specs : Mapping
+        The specs of the arrays from `SharedArrays.specs`.
+
+    Returns
+    -------
+    arrays : dict
+        The read only arrays by the keys.
+    """
+    arrays = dict()
+    for key, spec in specs.items():
+        if spec is None:
+            arrays[key] = None
+            continue
+        name, shape, dtype = spec
+        block = shared_memory.SharedMemory(name=name)
+        _ATTACHED.append(block)
+        view = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        view.flags.writeable = False
+        arrays[key] = view
+    return arrays
+
+
+def detach_arrays() -> None:
+    """Detach the blocks attached in this process whose views are all released."""
+    for block in list(_ATTACHED):
+        try:
+            block.close()
+        except BufferError:
+            # the views are still in use
+            continue
+        _ATTACHED.remove(block)
+    return
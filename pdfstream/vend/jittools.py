@@ -1,7 +1,10 @@
 """Just in time compiled tools (seperated from tools so we don't keep
 compiling them"""
 import numpy as np
-from numba import jit, boolean
+from numba import jit, boolean, prange
+
+# the minimum number of values used in the approximate median of a ring
+APPROX_MEDIAN_SAMPLES = 512
 
 
 @jit(cache=True, nopython=True, nogil=True)
@@ -28,9 +31,41 @@ def mask_ring_median(values_array, positions_array, alpha):  # pragma: no cover
 
 
 @jit(cache=True, nopython=True, nogil=True)
-def mask_ring_mean(values_array, positions_array, alpha):  # pragma: no cover
-    """Find outlier pixels in a single ring via a pixel by pixel method with
-    the mean.
+def approx_median(values_array, sample_size=APPROX_MEDIAN_SAMPLES):  # pragma: no cover
+    """Estimate the median from an evenly strided subsample of the values.
+
+    The values of a ring are sorted by q so the strided subsample covers the
+    whole ring. If the ring is not larger than twice the sample size, the
+    exact median is returned.
+
+    For a subsample of m values, the estimate lies between the
+    0.5 - 1 / sqrt(m) and 0.5 + 1 / sqrt(m) quantiles of the ring with about
+    95% probability. For the default m = 512 and normally distributed
+    intensities, it is within 0.11 standard deviation from the exact median,
+    which shifts the threshold alpha of the z-score by the same amount.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The ring values
+    sample_size : int
+        The minimum number of values in the subsample
+
+    Returns
+    -------
+    float
+        The estimated median
+    """
+    step = len(values_array) // sample_size
+    if step < 2:
+        return np.median(values_array)
+    return np.median(values_array[::step])
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def mask_ring_approx_median(values_array, positions_array, alpha):  # pragma: no cover
+    """Find outlier pixels in a single ring via a single pass with the
+    approximate median from `approx_median`.
 
     Parameters
     ----------
@@ -46,22 +81,455 @@ def mask_ring_mean(values_array, positions_array, alpha):  # pragma: no cover
     removals: np.ndarray
         The positions of pixels to be removed from the data
     """
-    m = np.ones(positions_array.shape, dtype=boolean)
-    removals = []
-    while True:
-        b = np.array([item in removals for item in positions_array], dtype=boolean)
-        m[b] = False
-        v = values_array[m]
-        if len(v) <= 1:
-            break
+    z = np.abs(values_array - approx_median(values_array)) / np.std(values_array)
+    removals = positions_array[np.where(z > alpha)]
+    return removals
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def _clip_ring_mean(values_array, alpha, alive):  # pragma: no cover
+    """Remove the worst pixel in a ring one by one until all the pixels are
+    within alpha standard deviations from the mean.
+
+    The removed pixels are set to False in the alive array. The statistics
+    are calculated on the alive pixels in their original order so the
+    results are the same as calculating them on a new array of the
+    remaining pixels.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The ring values
+    alpha: float
+        The threshold
+    alive : ndarray
+        The boolean array of the pixels that are not removed. It is modified
+        in place.
+    """
+    index = np.arange(len(values_array))
+    n = np.count_nonzero(alive)
+    while n > 1:
+        alive_index = index[alive]
+        v = values_array[alive_index]
         std = np.std(v)
         if std == 0.0:
             break
         norm_v_list = np.abs(v - np.mean(v)) / std
         if np.all(norm_v_list < alpha):
             break
-        # get the index of the worst pixel
-        worst_idx = np.argmax(norm_v_list)
-        # add the worst position to the mask
-        removals.append(positions_array[m][worst_idx])
-    return removals
+        # remove the worst pixel
+        alive[alive_index[np.argmax(norm_v_list)]] = False
+        n -= 1
+    return
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def mask_ring_mean(values_array, positions_array, alpha):  # pragma: no cover
+    """Find outlier pixels in a single ring via a pixel by pixel method with
+    the mean.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The ring values
+    positions_array : ndarray
+        The positions of the values
+    alpha: float
+        The threshold
+
+    Returns
+    -------
+    removals: np.ndarray
+        The positions of pixels to be removed from the data
+    """
+    alive = np.ones(positions_array.shape, dtype=boolean)
+    _clip_ring_mean(values_array, alpha, alive)
+    return positions_array[~alive]
+
+
+@jit(cache=True, nopython=True, parallel=True, error_model="numpy")
+def mask_all_rings(values_array, positions_array, offsets, alpha, mask):  # pragma: no cover
+    """Find outlier pixels in all rings via a single pass with the median.
+
+    The rings are processed in parallel. The statistics are the same as the
+    ones in `mask_ring_median`.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The values of all rings, sorted by rings
+    positions_array : ndarray
+        The flat positions of the values
+    offsets : ndarray
+        The start of each ring in the values_array and the total number of
+        values at the end
+    alpha: float
+        The threshold
+    mask : ndarray
+        The flat boolean mask. True pixels are good pixels. It is modified
+        in place.
+
+    Returns
+    -------
+    mask: np.ndarray
+        The mask with the outlier pixels set to False
+    """
+    for i in prange(len(offsets) - 1):
+        start, stop = offsets[i], offsets[i + 1]
+        if stop <= start:
+            continue
+        values = values_array[start:stop]
+        median = np.median(values)
+        std = np.std(values)
+        for j in range(stop - start):
+            if np.abs(values[j] - median) / std > alpha:
+                mask[positions_array[start + j]] = False
+    return mask
+
+
+@jit(cache=True, nopython=True, parallel=True, error_model="numpy")
+def mask_all_rings_approx_median(values_array, positions_array, offsets, alpha, mask):  # pragma: no cover
+    """Find outlier pixels in all rings via a single pass with the approximate
+    median from `approx_median`.
+
+    The rings are processed in parallel. The results are the same as the
+    ones from `mask_ring_approx_median`.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The values of all rings, sorted by rings
+    positions_array : ndarray
+        The flat positions of the values
+    offsets : ndarray
+        The start of each ring in the values_array and the total number of
+        values at the end
+    alpha: float
+        The threshold
+    mask : ndarray
+        The flat boolean mask. True pixels are good pixels. It is modified
+        in place.
+
+    Returns
+    -------
+    mask: np.ndarray
+        The mask with the outlier pixels set to False
+    """
+    for i in prange(len(offsets) - 1):
+        start, stop = offsets[i], offsets[i + 1]
+        if stop <= start:
+            continue
+        values = values_array[start:stop]
+        median = approx_median(values)
+        std = np.std(values)
+        for j in range(stop - start):
+            if np.abs(values[j] - median) / std > alpha:
+                mask[positions_array[start + j]] = False
+    return mask
+
+
+@jit(cache=True, nopython=True, parallel=True)
+def mask_all_rings_mean(values_array, positions_array, offsets, alpha, mask):  # pragma: no cover
+    """Find outlier pixels in all rings via a pixel by pixel method with the
+    mean.
+
+    The rings are processed in parallel. The results are the same as the
+    ones from `mask_ring_mean`.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The values of all rings, sorted by rings
+    positions_array : ndarray
+        The flat positions of the values
+    offsets : ndarray
+        The start of each ring in the values_array and the total number of
+        values at the end
+    alpha: float
+        The threshold
+    mask : ndarray
+        The flat boolean mask. True pixels are good pixels. It is modified
+        in place.
+
+    Returns
+    -------
+    mask: np.ndarray
+        The mask with the outlier pixels set to False
+    """
+    for i in prange(len(offsets) - 1):
+        start, stop = offsets[i], offsets[i + 1]
+        if stop <= start:
+            continue
+        alive = np.ones(stop - start, dtype=boolean)
+        _clip_ring_mean(values_array[start:stop], alpha, alive)
+        for j in range(stop - start):
+            if not alive[j]:
+                mask[positions_array[start + j]] = False
+    return mask
+
+
+@jit(cache=True, nopython=True, parallel=True, error_model="numpy")
+def mask_stack_rings(values_array, good_array, positions_array, bounds, alpha, mask):  # pragma: no cover
+    """Find outlier pixels in all rings of a stack of frames via a single pass
+    with the median.
+
+    The rings of all the frames are processed in parallel. The statistics are
+    the same as the ones in `mask_all_rings` for each frame.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The 2D array of the values of each frame, sorted by rings
+    good_array : ndarray
+        The 2D boolean array of the prior mask of each frame, sorted in the
+        same way as the values. True pixels are used in the statistics.
+    positions_array : ndarray
+        The flat positions of the sorted values in a frame
+    bounds : ndarray
+        The start of each ring in the sorted values and the total number of
+        values at the end
+    alpha: float
+        The threshold
+    mask : ndarray
+        The 2D boolean mask of the flat frames. True pixels are good pixels.
+        It is modified in place.
+
+    Returns
+    -------
+    mask: np.ndarray
+        The mask with the outlier pixels set to False
+    """
+    n_rings = len(bounds) - 1
+    for k in prange(values_array.shape[0] * n_rings):
+        f, i = k // n_rings, k % n_rings
+        start, stop = bounds[i], bounds[i + 1]
+        good = good_array[f, start:stop]
+        if not np.any(good):
+            continue
+        values = values_array[f, start:stop][good]
+        positions = positions_array[start:stop][good]
+        median = np.median(values)
+        std = np.std(values)
+        for j in range(len(values)):
+            if np.abs(values[j] - median) / std > alpha:
+                mask[f, positions[j]] = False
+    return mask
+
+
+@jit(cache=True, nopython=True, parallel=True)
+def mask_stack_rings_mean(values_array, good_array, positions_array, bounds, alpha, mask):  # pragma: no cover
+    """Find outlier pixels in all rings of a stack of frames via a pixel by
+    pixel method with the mean.
+
+    The rings of all the frames are processed in parallel. The results are
+    the same as the ones from `mask_all_rings_mean` for each frame.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The 2D array of the values of each frame, sorted by rings
+    good_array : ndarray
+        The 2D boolean array of the prior mask of each frame, sorted in the
+        same way as the values. True pixels are used in the statistics.
+    positions_array : ndarray
+        The flat positions of the sorted values in a frame
+    bounds : ndarray
+        The start of each ring in the sorted values and the total number of
+        values at the end
+    alpha: float
+        The threshold
+    mask : ndarray
+        The 2D boolean mask of the flat frames. True pixels are good pixels.
+        It is modified in place.
+
+    Returns
+    -------
+    mask: np.ndarray
+        The mask with the outlier pixels set to False
+    """
+    n_rings = len(bounds) - 1
+    for k in prange(values_array.shape[0] * n_rings):
+        f, i = k // n_rings, k % n_rings
+        start, stop = bounds[i], bounds[i + 1]
+        good = good_array[f, start:stop]
+        if not np.any(good):
+            continue
+        values = values_array[f, start:stop][good]
+        positions = positions_array[start:stop][good]
+        alive = np.ones(len(values), dtype=boolean)
+        _clip_ring_mean(values, alpha, alive)
+        for j in range(len(values)):
+            if not alive[j]:
+                mask[f, positions[j]] = False
+    return mask
+
+
+@jit(cache=True, nopython=True, parallel=True, error_model="numpy")
+def mask_stack_rings_approx_median(values_array, good_array, positions_array, bounds, alpha, mask):  # pragma: no cover
+    """Find outlier pixels in all rings of a stack of frames via a single pass
+    with the approximate median from `approx_median`.
+
+    The rings of all the frames are processed in parallel. The results are
+    the same as the ones from `mask_all_rings_approx_median` for each frame.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The 2D array of the values of each frame, sorted by rings
+    good_array : ndarray
+        The 2D boolean array of the prior mask of each frame, sorted in the
+        same way as the values. True pixels are used in the statistics.
+    positions_array : ndarray
+        The flat positions of the sorted values in a frame
+    bounds : ndarray
+        The start of each ring in the sorted values and the total number of
+        values at the end
+    alpha: float
+        The threshold
+    mask : ndarray
+        The 2D boolean mask of the flat frames. True pixels are good pixels.
+        It is modified in place.
+
+    Returns
+    -------
+    mask: np.ndarray
+        The mask with the outlier pixels set to False
+    """
+    n_rings = len(bounds) - 1
+    for k in prange(values_array.shape[0] * n_rings):
+        f, i = k // n_rings, k % n_rings
+        start, stop = bounds[i], bounds[i + 1]
+        good = good_array[f, start:stop]
+        if not np.any(good):
+            continue
+        values = values_array[f, start:stop][good]
+        positions = positions_array[start:stop][good]
+        median = approx_median(values)
+        std = np.std(values)
+        for j in range(len(values)):
+            if np.abs(values[j] - median) / std > alpha:
+                mask[f, positions[j]] = False
+    return mask
+
+
+@jit(cache=True, nopython=True, parallel=True, nogil=True)
+def subtract_images(img, dark, bg, bg_scale, lower, out, dk_out):  # pragma: no cover
+    """Subtract the dark and the scaled background and clip the flat images in one pass.
+
+    The values are computed in float64 and cast to the data type of the output. The None arguments are pruned
+    at the compilation.
+
+    Parameters
+    ----------
+    img : ndarray
+        The flat image
+    dark : ndarray or None
+        The flat dark image
+    bg : ndarray or None
+        The flat background image
+    bg_scale : float
+        The scale of the background image
+    lower : float or None
+        The lower limit of the output values. If None, no clipping.
+    out : ndarray
+        The flat output ``img - dark - bg_scale * bg``
+    dk_out : ndarray or None
+        The flat output ``img - dark``
+    """
+    for i in prange(img.shape[0]):
+        v = np.float64(img[i])
+        if dark is not None:
+            v -= np.float64(dark[i])
+            if dk_out is not None:
+                dk_out[i] = v
+        if bg is not None:
+            v -= bg_scale * np.float64(bg[i])
+        if lower is not None:
+            if v < lower:
+                v = lower
+        out[i] = v
+
+
+# the number of the pixels gathered at once in the reduction of the frames
+FRAME_BLOCK_SIZE = 512
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def _gather_frames(stack, start, stop, buf):  # pragma: no cover
+    """Gather the values of the pixels [start, stop) in all the frames into the rows of the buffer."""
+    for k in range(stack.shape[0]):
+        for i in range(start, stop):
+            buf[i - start, k] = stack[k, i]
+    return buf
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def _sorted_median(values, lo, hi):  # pragma: no cover
+    """The median of the sorted values in [lo, hi)."""
+    mid = (lo + hi) // 2
+    if (hi - lo) % 2 == 1:
+        return values[mid]
+    return 0.5 * (values[mid - 1] + values[mid])
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def median_frames(stack, out):  # pragma: no cover
+    """The median of the frames at each pixel.
+
+    Parameters
+    ----------
+    stack : ndarray
+        The (n_frames, n_pixels) values
+    out : ndarray
+        The (n_pixels,) output in float64
+    """
+    buf = np.empty((FRAME_BLOCK_SIZE, stack.shape[0]), dtype=np.float64)
+    for start in range(0, stack.shape[1], FRAME_BLOCK_SIZE):
+        stop = min(start + FRAME_BLOCK_SIZE, stack.shape[1])
+        _gather_frames(stack, start, stop, buf)
+        for i in range(stop - start):
+            out[start + i] = np.median(buf[i])
+    return out
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def sigma_clip_frames(stack, sigma, maxiters, out):  # pragma: no cover
+    """The mean of the frames at each pixel after the iterative sigma clipping.
+
+    The values farther than sigma times the standard deviation from the median are rejected until no value is
+    rejected or for maxiters iterations. The values kept are a contiguous window of the sorted values.
+
+    Parameters
+    ----------
+    stack : ndarray
+        The (n_frames, n_pixels) values
+    sigma : float
+        The threshold in the unit of the standard deviation
+    maxiters : int
+        The maximum number of the iterations
+    out : ndarray
+        The (n_pixels,) output in float64
+    """
+    n = stack.shape[0]
+    buf = np.empty((FRAME_BLOCK_SIZE, n), dtype=np.float64)
+    for start in range(0, stack.shape[1], FRAME_BLOCK_SIZE):
+        stop = min(start + FRAME_BLOCK_SIZE, stack.shape[1])
+        _gather_frames(stack, start, stop, buf)
+        for p in range(stop - start):
+            values = buf[p]
+            values.sort()
+            lo, hi = 0, n
+            for _ in range(maxiters):
+                center = _sorted_median(values, lo, hi)
+                std = np.std(values[lo:hi])
+                new_lo, new_hi = lo, hi
+                while new_lo < new_hi and values[new_lo] < center - sigma * std:
+                    new_lo += 1
+                while new_hi > new_lo and values[new_hi - 1] > center + sigma * std:
+                    new_hi -= 1
+                # nothing rejected or all rejected
+                if (new_lo == lo and new_hi == hi) or new_lo == new_hi:
+                    break
+                lo, hi = new_lo, new_hi
+            out[start + p] = np.mean(values[lo:hi])
+    return out
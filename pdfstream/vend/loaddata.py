@@ -1,3 +1,9 @@
+import io
+
+# the ascii bytes that can appear in a line of floats, including nan, inf and infinity
+_FLOAT_BYTES = b"0123456789+-.eE_naNAifIFtTyY \t\r\n\x0b\x0c\x1c\x1d\x1e\x1f"
+
+
 def load_data(filename, minrows=10, **kwargs):
     """Find and load data from a text file.
 
@@ -33,9 +39,18 @@ def load_data(filename, minrows=10, **kwargs):
         hiidx = max(-min(usecols), max(usecols) + 1)
         mincv = (hiidx, len(set(usecols)))
 
+    fast_reject = delimiter is None and usecols is None
+
     # Check if a line consists of floats only and return their count
     # Return zero if some strings cannot be converted.
     def countcolumnsvalues(line_):
+        # a line with an ascii byte that cannot be in a float is rejected
+        # without decoding and parsing
+        if fast_reject:
+            rest = line_.translate(None, _FLOAT_BYTES)
+            if rest and rest.isascii():
+                return 0, 0
+        line_ = line_.decode()
         try:
             words = line_.split(delimiter)
             # remove trailing blank columns
@@ -51,14 +66,15 @@ def load_data(filename, minrows=10, **kwargs):
         return nc, nv
 
     # make sure fid gets cleaned up
-    with open(filename, "rb") as fid:
+    with open(filename, "rb") as f:
+        content = f.read()
+    with io.BytesIO(content) as fid:
         # search for the start of datablock
         start = ncvblock = None
         fpos = (0, 0)
         nrows = 0
         for line in fid:
             fpos = (fpos[1], fpos[1] + len(line))
-            line = line.decode()
             ncv = countcolumnsvalues(line)
             if ncv < mincv:
                 start = None
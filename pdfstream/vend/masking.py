@@ -1,12 +1,170 @@
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
+from pyFAI import units
 from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
 from skbeam.core.mask import margin
 
-from pdfstream.vend.jittools import mask_ring_mean, mask_ring_median
+from pdfstream.vend.jittools import (
+    mask_all_rings,
+    mask_all_rings_approx_median,
+    mask_all_rings_mean,
+    mask_ring_approx_median,
+    mask_ring_mean,
+    mask_ring_median,
+    mask_stack_rings,
+    mask_stack_rings_approx_median,
+    mask_stack_rings_mean,
+)
 
-mask_ring_dict = {"median": mask_ring_median, "mean": mask_ring_mean}
+# the engines of the binned outlier masking
+MASK_ENGINES = ("numba", "thread", "vectorized", "tiled")
+mask_ring_dict = {
+    "median": mask_ring_median,
+    "mean": mask_ring_mean,
+    "approx_median": mask_ring_approx_median,
+}
+mask_all_rings_dict = {
+    "median": mask_all_rings,
+    "mean": mask_all_rings_mean,
+    "approx_median": mask_all_rings_approx_median,
+}
+mask_stack_dict = {
+    "median": mask_stack_rings,
+    "mean": mask_stack_rings_mean,
+    "approx_median": mask_stack_rings_approx_median,
+}
+# the statistics of the binned outlier masking
+AUTO_TYPES = tuple(mask_ring_dict)
+
+_MASK_POOL = None
+_MASK_POOL_SIZE = 20
+_MASK_POOL_LOCK = threading.Lock()
+
+
+def get_mask_pool():
+    """Get the thread pool shared by the masking in this process.
+
+    The pool is created at the first call and reused until
+    `shutdown_mask_pool` is called.
+
+    Returns
+    -------
+    ThreadPoolExecutor :
+        The shared pool.
+    """
+    global _MASK_POOL
+    with _MASK_POOL_LOCK:
+        if _MASK_POOL is None:
+            _MASK_POOL = ThreadPoolExecutor(
+                max_workers=_MASK_POOL_SIZE, thread_name_prefix="pdfstream-mask"
+            )
+        return _MASK_POOL
+
+
+def set_mask_pool_size(max_workers):
+    """Set the number of workers in the shared masking pool.
+
+    The running pool is shut down if its size is changed and a new one will
+    be created at the next call of `get_mask_pool`.
+
+    Parameters
+    ----------
+    max_workers : int
+        The maximum number of threads in the pool.
+    """
+    global _MASK_POOL_SIZE
+    if max_workers < 1:
+        raise ValueError("The pool size must be positive: {}.".format(max_workers))
+    if max_workers != _MASK_POOL_SIZE:
+        shutdown_mask_pool()
+        _MASK_POOL_SIZE = max_workers
+    return
+
+
+class MaskBuffers:
+    """The buffers of the tiled masking reused between the frames.
+
+    The sorted index of the binner is converted to int32 if the image is
+    small enough and the rings are grouped into chunks of at most
+    `chunk_size` pixels, unless a single ring is larger. The values and the
+    prior mask of one chunk are gathered into the preallocated buffers, so
+    the extra memory of a frame is bounded by the chunk size instead of
+    several full size copies of the image.
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        The maximum number of pixels in a chunk of rings. Defaults to 2 ** 20.
+    """
+
+    def __init__(self, chunk_size=2 ** 20):
+        self.chunk_size = chunk_size
+        self._binner = None
+        self._index = None
+        self._chunks = []
+        self._values = np.empty(0)
+        self._good = np.empty(0, dtype=bool)
+
+    def prepare(self, binner):
+        """Create the index and the chunks of the binner if it is new."""
+        if binner is self._binner:
+            return
+        idx = binner.argsort_index
+        dtype = np.int32 if idx.size < np.iinfo(np.int32).max else np.int64
+        self._index = np.asarray(idx, dtype=dtype)
+        bounds = np.zeros(len(binner.flatcount) + 1, dtype=np.int64)
+        np.cumsum(binner.flatcount, out=bounds[1:])
+        self._chunks = []
+        first = 0
+        while first < len(bounds) - 1:
+            limit = bounds[first] + self.chunk_size
+            last = max(np.searchsorted(bounds, limit, side="right") - 1, first + 1)
+            self._chunks.append((bounds[first], bounds[first : last + 1] - bounds[first]))
+            first = last
+        self._binner = binner
+        return
+
+    def get(self, dtype, size):
+        """Get the value and the mask buffers of at least the size."""
+        if self._values.dtype != dtype or self._values.size < size:
+            self._values = np.empty(size, dtype=dtype)
+        if self._good.size < size:
+            self._good = np.empty(size, dtype=bool)
+        return self._values[:size], self._good[:size]
+
+    def chunks(self):
+        """Yield the sorted index and the local ring bounds of each chunk."""
+        for start, bounds in self._chunks:
+            yield self._index[start : start + bounds[-1]], bounds
+
+
+_MASK_BUFFERS = threading.local()
+
+
+def get_mask_buffers():
+    """Get the buffers of the tiled masking of the current thread."""
+    buffers = getattr(_MASK_BUFFERS, "buffers", None)
+    if buffers is None:
+        buffers = _MASK_BUFFERS.buffers = MaskBuffers()
+    return buffers
+
+
+def shutdown_mask_pool(wait=True):
+    """Shut down the shared masking pool if it is running.
+
+    Parameters
+    ----------
+    wait : bool, optional
+        If True, wait for the pending jobs to finish. Defaults to True.
+    """
+    global _MASK_POOL
+    with _MASK_POOL_LOCK:
+        pool, _MASK_POOL = _MASK_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
+    return
 
 
 def map_to_binner(pixel_map, bins, mask=None):
@@ -51,6 +209,99 @@ def generate_binner(geo, img_shape, mask=None):
     return map_to_binner(*generate_map_bin(geo, img_shape), mask=mask)
 
 
+class RingIndex:
+    """The pixels sorted by rings. It can replace the binner in the masking.
+
+    Parameters
+    ----------
+    q : np.ndarray
+        The q map
+    bins : np.ndarray
+        The pixel resolution bins
+    argsort_index : np.ndarray
+        The flat index of pixels sorted by the rings
+    offsets : np.ndarray
+        The start of each ring in the argsort_index. The last element is the
+        total number of pixels.
+    """
+
+    def __init__(self, q, bins, argsort_index, offsets):
+        self.q = q
+        self.bins = bins
+        self.argsort_index = argsort_index
+        self.offsets = offsets
+
+    @property
+    def flatcount(self):
+        """The number of pixels in each ring."""
+        return np.diff(self.offsets)
+
+    @classmethod
+    def from_binner(cls, q, bins, binner):
+        """Create the ring index from the q map, bins and their binner."""
+        offsets = np.zeros(len(binner.flatcount) + 1, dtype=np.int64)
+        np.cumsum(binner.flatcount, out=offsets[1:])
+        return cls(q, bins, binner.argsort_index, offsets)
+
+
+def generate_ring_index(geo, img_shape):
+    """Create a pixel resolution RingIndex instance
+
+    Parameters
+    ----------
+    geo : pyFAI.geometry.Geometry instance
+        The calibrated geometry
+    img_shape : tuple
+        The shape of the image.
+
+    Returns
+    -------
+    RingIndex :
+        The pixels sorted by the rings.
+    """
+    q, qbin = generate_map_bin(geo, img_shape)
+    return RingIndex.from_binner(q, qbin, map_to_binner(q, qbin))
+
+
+def prior_mask(img, edge=30, lower_thresh=0.0, upper_thresh=None, tmsk=None):
+    """The mask of an image before the binned outlier masking.
+
+    It is the working mask that `mask_img` removes the outliers from.
+
+    Parameters
+    ----------
+    img: np.ndarray
+        The image to be masked
+    edge: int, optional
+        The number of edge pixels to mask. If None, no edge mask is applied
+    lower_thresh: float, optional
+        Pixels with values less than this threshold are masked. If None, no
+        lower threshold mask is applied
+    upper_thresh: float, optional
+        Pixels with values greater than this threshold are masked. If None,
+        no upper threshold mask is applied
+    tmsk: np.ndarray, optional
+        The starting mask to be compounded on. If None mask generated from
+        scratch.
+
+    Returns
+    -------
+    working_mask: np.ndarray
+        The mask as a boolean array. True pixels are good pixels.
+    """
+    if tmsk is None:
+        working_mask = np.ones(np.shape(img), dtype=bool)
+    else:
+        working_mask = tmsk.astype(bool)
+    if edge:
+        working_mask &= margin(np.shape(img), edge)
+    if lower_thresh is not None:
+        working_mask &= img >= lower_thresh
+    if upper_thresh is not None:
+        working_mask &= img <= upper_thresh
+    return working_mask
+
+
 def mask_img(
     img,
     binner,
@@ -61,6 +312,7 @@ def mask_img(
     auto_type="median",
     tmsk=None,
     pool=None,
+    engine=None,
 ):
     """
     Mask an image based off of various methods
@@ -86,14 +338,24 @@ def mask_img(
         a linear distribution of alphas from alpha[0] to alpha[1], if array
         then we just use that as the distribution of alphas. Defaults to 3.
         If None, no outlier masking applied.
-    auto_type: {'median', 'mean'}, optional
+    auto_type: {'median', 'mean', 'approx_median'}, optional
         The type of binned outlier masking to be done, 'median' is faster,
-        where 'mean' is more accurate, defaults to 'median'.
+        where 'mean' is more accurate, defaults to 'median'. 'approx_median'
+        estimates the median of large rings from a subsample, see
+        `pdfstream.vend.jittools.approx_median` for its error.
     tmsk: np.ndarray, optional
         The starting mask to be compounded on. Defaults to None. If None mask
         generated from scratch.
     pool : Executor instance
-        A pool against which jobs can be submitted for parallel processing
+        A pool against which jobs can be submitted for parallel processing.
+        If None, use the shared pool from `get_mask_pool`.
+    engine : {'numba', 'thread', 'vectorized', 'tiled'}, optional
+        The engine of the binned outlier masking. 'numba' masks all the rings
+        in one parallel compiled kernel, 'thread' submits one job per ring to
+        the pool, 'vectorized' computes the statistics of all the rings at
+        once with segmented numpy operations, 'tiled' runs the compiled
+        kernel on chunks of rings in reused buffers to bound the memory.
+        Defaults to None, which uses 'numba'.
 
     Returns
     -------
@@ -103,30 +365,113 @@ def mask_img(
 
     """
 
-    if tmsk is None:
-        working_mask = np.ones(np.shape(img)).astype(bool)
-    else:
-        working_mask = tmsk.copy()
-    if edge:
-        working_mask *= margin(np.shape(img), edge)
-    if lower_thresh is not None:
-        working_mask *= (img >= lower_thresh).astype(bool)
-    if upper_thresh is not None:
-        working_mask *= (img <= upper_thresh).astype(bool)
+    working_mask = prior_mask(
+        img,
+        edge=edge,
+        lower_thresh=lower_thresh,
+        upper_thresh=upper_thresh,
+        tmsk=tmsk,
+    )
     if alpha:
-        working_mask *= binned_outlier(
+        working_mask &= binned_outlier(
             img,
             binner,
             alpha=alpha,
             tmsk=working_mask,
             mask_method=auto_type,
             pool=pool,
+            engine=engine,
         )
-    working_mask = working_mask.astype(bool)
     return working_mask
 
 
-def binned_outlier(img, binner, tmsk, alpha=3, mask_method="median", pool=None):
+def mask_stack(
+    stack,
+    binner,
+    edge=30,
+    lower_thresh=0.0,
+    upper_thresh=None,
+    alpha=2,
+    auto_type="median",
+    tmsk=None,
+    engine=None,
+    chunk_size=16,
+):
+    """Mask every frame in a stack of images with one binner.
+
+    The frames are sorted by the rings with the same index and the rings of
+    a chunk of frames are masked in one parallel compiled kernel. The mask of
+    each frame is the same as the one from `mask_img` of that frame.
+
+    Parameters
+    ----------
+    stack: np.ndarray
+        The 3D array of the frames
+    binner : BinnedStatistic1D instance
+        The binned statistics information of a frame
+    edge: int, optional
+        The number of edge pixels to mask. Defaults to 30. If None, no edge
+        mask is applied
+    lower_thresh: float, optional
+        Pixels with values less than this threshold will be masked.
+        Defaults to 0.0. If None, no lower threshold mask is applied
+    upper_thresh: float, optional
+        Pixels with values greater than this threshold will be masked.
+        Defaults to None. If None, no upper threshold mask is applied.
+    alpha: float, optional
+        The number of acceptable standard deviations. Defaults to 2. If None,
+        no outlier masking applied.
+    auto_type: {'median', 'mean', 'approx_median'}, optional
+        The type of binned outlier masking, defaults to 'median'.
+    tmsk: np.ndarray, optional
+        The 2D starting mask shared by all frames. True pixels are good
+        pixels. Defaults to None.
+    engine : {'numba'}, optional
+        Only the 'numba' engine is supported for the stacks. Defaults to None,
+        which uses 'numba'.
+    chunk_size : int, optional
+        The number of frames sorted and masked together. It bounds the
+        memory of the sorted copy of the frames. Defaults to 16.
+
+    Returns
+    -------
+    np.ndarray
+        The 3D mask as a boolean array. True pixels are good pixels, False
+        pixels are masked out.
+    """
+    if engine not in (None, "numba"):
+        raise ValueError("Only the 'numba' engine supports the stacks.")
+    stack = np.asarray(stack)
+    if stack.ndim != 3:
+        raise ValueError("The stack must be 3D, got ndim = {}.".format(stack.ndim))
+    shape = stack.shape[1:]
+    prior = np.ones(shape, dtype=bool) if tmsk is None else tmsk.astype(bool)
+    if edge:
+        prior = prior & margin(shape, edge)
+    idx = binner.argsort_index
+    bounds = np.zeros(len(binner.flatcount) + 1, dtype=np.int64)
+    np.cumsum(binner.flatcount, out=bounds[1:])
+    masks = np.empty(stack.shape, dtype=bool)
+    for start in range(0, len(stack), chunk_size):
+        frames = stack[start : start + chunk_size]
+        working_mask = np.broadcast_to(prior, frames.shape).copy()
+        if lower_thresh is not None:
+            working_mask &= frames >= lower_thresh
+        if upper_thresh is not None:
+            working_mask &= frames <= upper_thresh
+        working_mask = working_mask.reshape(len(frames), -1)
+        if alpha:
+            flat = frames.reshape(len(frames), -1)
+            mask_stack_dict[auto_type](
+                flat[:, idx], working_mask[:, idx], idx, bounds, alpha, working_mask
+            )
+        masks[start : start + chunk_size] = working_mask.reshape(frames.shape)
+    return masks
+
+
+def binned_outlier(
+    img, binner, tmsk, alpha=3, mask_method="median", pool=None, engine=None
+):
     """Sigma Clipping based masking.
 
     Parameters
@@ -139,19 +484,43 @@ def binned_outlier(img, binner, tmsk, alpha=3, mask_method="median", pool=None):
         The number of standard deviations to clip, defaults to 3
     tmsk : np.ndarray, optional
         Prior mask. If None don't use a prior mask, defaults to None.
-    mask_method : {'median', 'mean'}, optional
+    mask_method : {'median', 'mean', 'approx_median'}, optional
         The method to use for creating the mask, median is faster, mean is more
-        accurate. Defaults to median.
+        accurate, approx_median is the fastest. Defaults to median.
     pool : Executor instance
-        A pool against which jobs can be submitted for parallel processing
+        A pool against which jobs can be submitted for parallel processing.
+        If None, use the shared pool from `get_mask_pool`. The pool is not
+        shut down after the jobs are done.
+    engine : {'numba', 'thread', 'vectorized', 'tiled'}, optional
+        The engine to use. All engines give the same mask. The 'vectorized'
+        engine only supports the median method. Defaults to None, which uses
+        'numba'.
 
     Returns
     -------
     np.ndarray:
         The mask
     """
+    if engine is None:
+        engine = "numba"
+    if engine == "numba":
+        return _binned_outlier_numba(
+            img, binner, tmsk, alpha=alpha, mask_method=mask_method
+        )
+    if engine == "vectorized":
+        if mask_method != "median":
+            raise ValueError(
+                "The 'vectorized' engine only supports mask_method='median'."
+            )
+        return _binned_outlier_vectorized(img, binner, tmsk, alpha=alpha)
+    if engine == "tiled":
+        return _binned_outlier_tiled(
+            img, binner, tmsk, alpha=alpha, mask_method=mask_method
+        )
+    if engine != "thread":
+        raise ValueError("Unknown engine: {}.".format(engine))
     if pool is None:
-        pool = ThreadPoolExecutor(max_workers=20)
+        pool = get_mask_pool()
     # skbeam 0.0.12 doesn't have argsort_index cached
     idx = binner.argsort_index
     tmsk = tmsk.flatten()
@@ -167,9 +536,7 @@ def binned_outlier(img, binner, tmsk, alpha=3, mask_method="median", pool=None):
             t.append((vm, (pfs[i : i + k][m]), alpha))
         i += k
     p_err = np.seterr(all="ignore")
-    # only run tqdm on mean since it is slow
-    with pool as p:
-        futures = [p.submit(mask_ring_dict[mask_method], *x) for x in t]
+    futures = [pool.submit(mask_ring_dict[mask_method], *x) for x in t]
     removals = []
     for f in as_completed(futures):
         removals.extend(f.result())
@@ -179,6 +546,287 @@ def binned_outlier(img, binner, tmsk, alpha=3, mask_method="median", pool=None):
     return tmsk.astype(bool)
 
 
+def ring_segments(img, binner, tmsk):
+    """Sort the unmasked pixels by rings.
+
+    Parameters
+    ----------
+    img : np.ndarray
+        The image
+    binner : BinnedStatistic1D instance
+        The binned statistics information
+    tmsk : np.ndarray
+        The mask. True pixels are good pixels.
+
+    Returns
+    -------
+    values : np.ndarray
+        The values of the good pixels sorted by rings.
+    positions : np.ndarray
+        The flat positions of the values in the image.
+    offsets : np.ndarray
+        The start of each ring in the values. The last element is the total
+        number of values.
+    """
+    idx = binner.argsort_index
+    m = tmsk.ravel()[idx].astype(bool)
+    values = img.ravel()[idx][m]
+    positions = idx[m]
+    counts = np.asarray(binner.flatcount)
+    starts = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    # count the kept pixels in each ring without a full size cumulative sum
+    kept = np.zeros(len(counts), dtype=np.int64)
+    filled = counts > 0
+    if np.any(filled):
+        kept[filled] = np.add.reduceat(m, starts[filled], dtype=np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(kept, out=offsets[1:])
+    return values, positions, offsets
+
+
+def _ring_buckets(counts, growth=1.25):
+    """Group the non-empty rings into buckets of similar sizes.
+
+    Yield the index of the rings in the bucket and an index matrix of shape
+    (width, number of rings). The column j holds the positions of the values
+    of the ring j and is padded by -1 after the end of the ring.
+    """
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    order = np.argsort(counts, kind="stable")
+    sorted_counts = counts[order]
+    start = np.searchsorted(sorted_counts, 1)
+    while start < len(order):
+        stop = np.searchsorted(
+            sorted_counts, sorted_counts[start] * growth + 8, side="right"
+        )
+        rings = order[start:stop]
+        rows = np.arange(sorted_counts[stop - 1])[:, np.newaxis]
+        idx = np.where(rows < counts[rings], offsets[rings] + rows, -1)
+        yield rings, idx
+        start = stop
+
+
+def ring_stats(values, offsets):
+    """Calculate the median and standard deviation of every ring.
+
+    The statistics are calculated in the same way as the `np.median` and
+    `np.std` in the numba compiled `mask_ring_median` so that the results are
+    identical. The sums in each ring are accumulated from left to right in
+    the padded columns of bucketed rings.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The values sorted by rings.
+    offsets : np.ndarray
+        The start of each ring in the values and the total number of values.
+
+    Returns
+    -------
+    median : np.ndarray
+        The median of each ring. NaN for empty rings.
+    std : np.ndarray
+        The standard deviation of each ring. NaN for empty rings.
+    """
+    counts = np.diff(offsets)
+    # numba accumulates the mean in float64 for integers and keeps the float type
+    dtype = values.dtype if values.dtype.kind == "f" else np.dtype(np.float64)
+    values = values.astype(dtype, copy=False)
+    median = np.full(len(counts), np.nan)
+    mean = np.zeros(len(counts), dtype=dtype)
+    ssd = np.zeros(len(counts))
+    buckets = list(_ring_buckets(counts))
+    padded = np.append(values, dtype.type(0))
+    with np.errstate(all="ignore"):
+        for rings, idx in buckets:
+            block = padded[idx]
+            n = counts[rings]
+            mean[rings] = block.sum(axis=0) / n
+            block[idx < 0] = np.inf
+            block.sort(axis=0)
+            cols = np.arange(len(rings))
+            median[rings] = (block[(n - 1) // 2, cols] + block[n // 2, cols]) / 2.0
+        dev = values - np.repeat(mean, counts)
+        padded = np.append((dev * dev).astype(np.float64), 0.0)
+        for rings, idx in buckets:
+            ssd[rings] = padded[idx].sum(axis=0)
+        std = np.sqrt(ssd / counts)
+    return median, std
+
+
+def _binned_outlier_numba(img, binner, tmsk, alpha=3, mask_method="median"):
+    """Masking of all rings in one compiled kernel."""
+    values, positions, offsets = ring_segments(img, binner, tmsk)
+    tmsk = tmsk.astype(bool).ravel()
+    mask_all_rings_dict[mask_method](values, positions, offsets, alpha, tmsk)
+    tmsk = tmsk.reshape(np.shape(img))
+    return tmsk
+
+
+def _binned_outlier_tiled(
+    img, binner, tmsk, alpha=3, mask_method="median", buffers=None
+):
+    """Masking of the rings chunk by chunk in the reused buffers."""
+    if buffers is None:
+        buffers = get_mask_buffers()
+    buffers.prepare(binner)
+    flat_img = np.ascontiguousarray(img).reshape(1, -1)
+    mask = np.array(tmsk, dtype=bool).reshape(1, -1)
+    kernel = mask_stack_dict[mask_method]
+    for index, bounds in buffers.chunks():
+        values, good = buffers.get(flat_img.dtype, len(index))
+        np.take(flat_img[0], index, out=values)
+        np.take(mask[0], index, out=good)
+        kernel(values[np.newaxis], good[np.newaxis], index, bounds, alpha, mask)
+    return mask.reshape(np.shape(img))
+
+
+def _binned_outlier_vectorized(img, binner, tmsk, alpha=3):
+    """Single pass median masking of all rings with segmented operations."""
+    values, positions, offsets = ring_segments(img, binner, tmsk)
+    median, std = ring_stats(values, offsets)
+    counts = np.diff(offsets)
+    with np.errstate(all="ignore"):
+        z = np.abs(values.astype(np.float64) - np.repeat(median, counts))
+        z /= np.repeat(std, counts)
+    tmsk = tmsk.flatten()
+    tmsk[positions[z > alpha]] = False
+    tmsk = tmsk.reshape(np.shape(img))
+    return tmsk.astype(bool)
+
+
+def mask_drift(
+    img,
+    binner,
+    mask,
+    median,
+    std,
+    alpha=3,
+    fraction=0.01,
+    tmsk=None,
+    lower_thresh=None,
+    upper_thresh=None,
+    seed=None,
+):
+    """Estimate how much a mask calculated before disagrees with a new image.
+
+    A random fraction of the pixels in the new image are classified using the
+    ring statistics from the old image and the results are compared with the
+    old mask.
+
+    Parameters
+    ----------
+    img : np.ndarray
+        The new image
+    binner : BinnedStatistic1D instance
+        The binned statistics information
+    mask : np.ndarray
+        The old mask as a boolean array. True pixels are good pixels.
+    median : np.ndarray
+        The median of each ring in the old image, see `ring_stats`
+    std : np.ndarray
+        The standard deviation of each ring in the old image
+    alpha : float, optional
+        The number of standard deviations to clip, defaults to 3
+    fraction : float, optional
+        The fraction of the pixels to check, defaults to 0.01
+    tmsk : np.ndarray, optional
+        The prior mask. The pixels masked out in it are not checked.
+    lower_thresh : float, optional
+        Pixels with values less than this threshold are bad pixels.
+    upper_thresh : float, optional
+        Pixels with values greater than this threshold are bad pixels.
+    seed : int, optional
+        The seed of the random sampling.
+
+    Returns
+    -------
+    float :
+        The fraction of the checked pixels whose classification is changed.
+    """
+    idx = binner.argsort_index
+    offsets = np.zeros(len(binner.flatcount) + 1, dtype=np.int64)
+    np.cumsum(binner.flatcount, out=offsets[1:])
+    rng = np.random.default_rng(seed)
+    sample = rng.integers(0, len(idx), max(int(len(idx) * fraction), 1))
+    ring = np.searchsorted(offsets, sample, side="right") - 1
+    positions = idx[sample]
+    keep = np.isfinite(std[ring])
+    if tmsk is not None:
+        keep &= tmsk.ravel()[positions].astype(bool)
+    positions, ring = positions[keep], ring[keep]
+    if positions.size == 0:
+        return 0.0
+    values = img.ravel()[positions].astype(np.float64)
+    with np.errstate(all="ignore"):
+        good = ~(np.abs(values - median[ring]) / std[ring] > alpha)
+    if lower_thresh is not None:
+        good &= values >= lower_thresh
+    if upper_thresh is not None:
+        good &= values <= upper_thresh
+    return float(np.mean(good != mask.ravel()[positions].astype(bool)))
+
+
+def delta_q(geo, img_shape):
+    """The max distance between the center and the corners of pixels in q
+
+    It gives the same array as `geo.deltaQ` in nm^-1 but reduces the corners
+    in place instead of creating the 3D array of all the differences.
+
+    Parameters
+    ----------
+    geo : pyFAI.geometry.Geometry instance
+        The calibrated geometry
+    img_shape : tuple
+        The shape of the image
+
+    Returns
+    -------
+    np.ndarray
+        The delta q map in nm^-1
+    """
+    try:
+        corners = geo.corner_array(img_shape, unit=units.Q, scale=False)[..., 0]
+    except (AttributeError, TypeError):
+        return geo.deltaQ(img_shape)
+    q = geo.qArray(img_shape)
+    delta = np.abs(corners[..., 0] - q)
+    for i in range(1, corners.shape[-1]):
+        np.maximum(delta, np.abs(corners[..., i] - q), out=delta)
+    return delta
+
+
+def binned_max(x, values, bins):
+    """The maximum of the values in each bin of x
+
+    The pixels are assigned to the bins in the same way as the
+    BinnedStatistic1D but the maximum is reduced in one pass without a
+    python loop over the bins.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The 1D positions of the values
+    values : np.ndarray
+        The 1D values
+    bins : np.ndarray
+        The bin edges
+
+    Returns
+    -------
+    np.ndarray
+        The maximum in each bin. Empty bins and NaN are zero.
+    """
+    idx = np.digitize(x, bins)
+    # values on the rightmost edge are in the last bin as in BinnedStatistic1D
+    decimal = int(-np.log10(np.diff(bins).min())) + 6
+    idx[np.around(x, decimal) == np.around(bins[-1], decimal)] -= 1
+    result = np.full(len(bins) + 1, -np.inf)
+    np.maximum.at(result, idx, values)
+    return np.nan_to_num(result[1:-1], neginf=0.0)
+
+
 def generate_map_bin(geo, img_shape):
     """Create a q map and the pixel resolution bins
 
@@ -198,15 +846,13 @@ def generate_map_bin(geo, img_shape):
     """
     r = geo.rArray(img_shape)
     q = geo.qArray(img_shape) / 10  # type: np.ndarray
-    q_dq = geo.deltaQ(img_shape) / 10  # type: np.ndarray
+    q_dq = delta_q(geo, img_shape) / 10  # type: np.ndarray
 
     pixel_size = [getattr(geo, a) for a in ["pixel1", "pixel2"]]
     rres = np.hypot(*pixel_size)
     rbins = np.arange(np.min(r) - rres / 2.0, np.max(r) + rres / 2.0, rres / 2.0)
-    rbinned = BinnedStatistic1D(r.ravel(), statistic=np.max, bins=rbins)
 
-    qbin_sizes = rbinned(q_dq.ravel())
-    qbin_sizes = np.nan_to_num(qbin_sizes)
+    qbin_sizes = binned_max(r.ravel(), q_dq.ravel(), rbins)
     qbin = np.cumsum(qbin_sizes)
     qbin[0] = np.min(q_dq)
     if np.max(q) > qbin[-1]:
@@ -233,10 +879,9 @@ def mask_img_pyfai(img, binner, tmsk=None, **kwargs):
     Returns
     -------
     tmsk: np.ndarray
-        The mask as a int array. 0 pixels are good pixels, 1 pixels
+        The mask as a bool array. False pixels are good pixels, True pixels
         are masked out.
     """
     mask = np.invert(tmsk.astype(bool)) if tmsk is not None else None
-    mask = mask_img(img, binner, tmsk=mask)
-    mask = np.invert(mask).astype(int)
-    return mask
+    mask = mask_img(img, binner, tmsk=mask, **kwargs)
+    return np.invert(mask)
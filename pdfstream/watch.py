@@ -0,0 +1,262 @@
+"""Watch a directory for the completed image files.
+
+The new files are found by the inotify on Linux. If the inotify is not available, like on the other platforms or
+on some network file systems, the directory is scanned periodically. In both cases, a file is only yielded when its
+size and modification time have not changed for a settle time so that the partially written files are skipped.
+"""
+import ctypes
+import ctypes.util
+import fnmatch
+import json
+import os
+import select
+import struct
+import sys
+import time
+import typing as T
+from pathlib import Path
+
+import pdfstream.io as io
+
+# the inotify events of a file closed after writing or moved into the directory
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+# the header of an inotify event: wd, mask, cookie, len
+_EVENT_HEADER = struct.Struct("iIII")
+
+# the size and the modification time of a file
+FileState = T.Tuple[int, int]
+
+
+def file_state(path: T.Union[str, Path]) -> FileState:
+    """The size and the modification time in ns of a file."""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+class _Inotify:
+    """The inotify watch of a directory by the libc."""
+
+    def __init__(self, directory: T.Union[str, Path]):
+        if not sys.platform.startswith("linux"):
+            raise OSError("The inotify is only available on Linux.")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed.")
+        wd = libc.inotify_add_watch(fd, os.fsencode(str(directory)), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {}.".format(directory))
+        self.fd = fd
+
+    def read(self, timeout: float) -> T.List[str]:
+        """Wait for the events and return the names of the files in them."""
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0.0))
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            _, _, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        return
+
+
+class DirectoryWatcher:
+    """Iterate the paths of the completed files matching the pattern in a directory.
+
+    The files already in the directory are yielded first. Then, the watcher waits for the new files until there
+    is no new file for `timeout` seconds or forever if `timeout` is None.
+
+    Parameters
+    ----------
+    directory : str or Path
+        The directory to watch. The sub-directories are not watched.
+
+    pattern : str
+        The glob pattern of the file names.
+
+    settle_time : float
+        The seconds that the size and modification time of a file must stay unchanged before it is yielded.
+
+    poll_interval : float
+        The seconds between the scans of the directory in the polling mode. It is also the longest wait for an
+        event in the inotify mode.
+
+    poll : bool
+        If True, always scan the directory instead of using the inotify. Use it when the files are written by
+        another machine to a network file system, where the inotify does not see the changes.
+
+    timeout : float
+        The seconds to wait for a new file before stopping. If None, watch forever.
+
+    seen : Mapping
+        The states of the files done before, like those in a `Manifest`. A file is skipped if its state is the same.
+    """
+
+    def __init__(
+        self,
+        directory: T.Union[str, Path],
+        pattern: str = "*.tiff",
+        settle_time: float = 1.0,
+        poll_interval: float = 1.0,
+        poll: bool = False,
+        timeout: float = None,
+        seen: T.Mapping[str, FileState] = None,
+    ):
+        self.directory = Path(directory)
+        self.pattern = pattern
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.poll = poll
+        self.timeout = timeout
+        self._seen: T.Dict[str, FileState] = dict(seen) if seen else dict()
+        # the name, the last state and the time when the state was first found
+        self._candidates: T.Dict[str, T.Tuple[FileState, float]] = dict()
+        self._inotify: T.Optional[_Inotify] = None
+
+    @property
+    def mode(self) -> str:
+        """'inotify' or 'poll'."""
+        return "inotify" if self._inotify is not None else "poll"
+
+    def __iter__(self) -> T.Iterator[Path]:
+        if not self.poll:
+            try:
+                self._inotify = _Inotify(self.directory)
+            except (OSError, AttributeError) as error:
+                io.server_message("Inotify is not available ({}). Scan the directory instead.".format(error))
+        try:
+            self._scan()
+            last_found = time.monotonic()
+            while True:
+                for path in self._ready():
+                    yield path
+                    last_found = time.monotonic()
+                if self.timeout is not None and time.monotonic() - last_found >= self.timeout:
+                    return
+                self._wait()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Stop the inotify watch."""
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        return
+
+    def _match(self, name: str) -> bool:
+        return fnmatch.fnmatch(name, self.pattern)
+
+    def _scan(self) -> None:
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and self._match(entry.name):
+                    self._candidates.setdefault(entry.name, (None, 0.0))
+        return
+
+    def _wait(self) -> None:
+        if self._inotify is None:
+            time.sleep(self.poll_interval)
+            self._scan()
+            return
+        timeout = self.poll_interval
+        if self._candidates:
+            # wake up when the pending files are settled
+            timeout = min(timeout, max(self.settle_time, 0.05))
+        for name in self._inotify.read(timeout):
+            if self._match(name):
+                self._candidates.setdefault(name, (None, 0.0))
+        return
+
+    def _ready(self) -> T.List[Path]:
+        ready = []
+        now = time.monotonic()
+        for name, (state, found) in list(self._candidates.items()):
+            try:
+                current = file_state(self.directory.joinpath(name))
+            except FileNotFoundError:
+                del self._candidates[name]
+                continue
+            if self._seen.get(name) == current:
+                del self._candidates[name]
+                continue
+            if current != state:
+                # new or changed since the last check
+                self._candidates[name] = (current, now)
+                if self.settle_time > 0:
+                    continue
+            elif now - found < self.settle_time:
+                continue
+            # an empty file is not completed
+            if current[0] == 0:
+                continue
+            del self._candidates[name]
+            self._seen[name] = current
+            ready.append(self.directory.joinpath(name))
+        ready.sort()
+        return ready
+
+
+class Manifest:
+    """The record of the files done in a directory saved as json lines.
+
+    Each line is a json object of the file name, size, modification time in ns and the output file. The lines are
+    appended so that a record is never lost when the process is killed.
+
+    Parameters
+    ----------
+    path : str or Path
+        The path of the manifest file. It is created if it does not exist.
+    """
+
+    def __init__(self, path: T.Union[str, Path]):
+        self.path = Path(path)
+        self.states: T.Dict[str, FileState] = dict()
+        # the last line is partially written by a killed process
+        self._broken_end = False
+        if self.path.is_file():
+            self._load()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.states
+
+    def _load(self) -> None:
+        with self.path.open("r") as f:
+            for line in f:
+                self._broken_end = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                    self.states[record["name"]] = (record["size"], record["mtime_ns"])
+                except (ValueError, KeyError, TypeError):
+                    # the last line may be partially written
+                    continue
+        return
+
+    def record(self, name: str, state: FileState, output: str = None) -> None:
+        """Append a record of a file done."""
+        self.states[name] = tuple(state)
+        line = json.dumps({"name": name, "size": state[0], "mtime_ns": state[1], "output": output})
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a") as f:
+            if self._broken_end:
+                f.write("\n")
+                self._broken_end = False
+            f.write(line + "\n")
+        return
@@ -3,6 +3,7 @@ import numpy as np
 import pytest
 
 import pdfstream.integration.main as integ
+import pdfstream.io as io
 
 plt.ioff()
 
@@ -100,8 +101,92 @@ def test_get_chi_sanity(test_data, img, bg_img, dk_img):
     plt.close()
 
 
+@pytest.mark.parametrize("use_matrix", [False, True])
+def test_get_chi_bg_mode(test_data, use_matrix):
+    kwargs = dict(
+        bg_img=test_data["Kapton_img"],
+        mask=test_data["mask"],
+        bg_scale=0.001,
+        mask_setting="OFF",
+        integ_setting={"npt": 1024},
+        plot_setting="OFF",
+        img_setting="OFF",
+        use_matrix=use_matrix,
+    )
+    expect = integ.get_chi(test_data["ai"], test_data["Ni_img"], **kwargs)[0]
+    for _ in range(2):
+        chi = integ.get_chi(
+            test_data["ai"], test_data["Ni_img"], bg_mode="1d", **kwargs
+        )[0]
+        assert np.allclose(chi, expect, rtol=0.0, atol=1e-6 * np.abs(expect[1]).max())
+    with pytest.raises(ValueError):
+        integ.get_chi(test_data["ai"], test_data["Ni_img"], bg_mode="3d", **kwargs)
+    plt.close()
+
+
+def test_get_chi_float32(test_data):
+    """The float32 results agree with the float64 ones within 1e-4 of the peak and 0.1% of the mask."""
+    kwargs = dict(
+        bg_img=test_data["Kapton_img"],
+        bg_scale=0.001,
+        integ_setting={"npt": 1024},
+        plot_setting="OFF",
+        img_setting="OFF",
+    )
+    chi32, _, _, img32, mask32 = integ.get_chi(
+        test_data["ai"], test_data["Ni_img"], dtype="float32", **kwargs
+    )[:5]
+    chi64, _, _, img64, mask64 = integ.get_chi(
+        test_data["ai"], test_data["Ni_img"], dtype="float64", **kwargs
+    )[:5]
+    assert img32.dtype == np.float32
+    assert img64.dtype == np.float64
+    assert np.count_nonzero(mask32 != mask64) <= 1e-3 * mask64.size
+    assert np.allclose(chi32[0], chi64[0])
+    assert np.allclose(chi32[1], chi64[1], rtol=0.0, atol=1e-4 * chi64[1].max())
+    plt.close()
+
+
 def test_avg_imgs(test_data):
     res = integ.avg_imgs(
         [test_data["white_img"], test_data["white_img"]], weights=[1, 1]
     )
     assert np.array_equal(res, test_data["white_img"])
+
+
+@pytest.mark.parametrize("weights", [None, [1, 2, 0.5]])
+def test_avg_imgs_stream(weights):
+    imgs = [np.full((4, 5), i, dtype=np.uint16) for i in range(3)]
+    res = integ.avg_imgs((img for img in imgs), weights=weights)
+    expect = np.average(np.stack(imgs), axis=0, weights=weights)
+    assert res.dtype == expect.dtype
+    assert np.allclose(res, expect)
+    with pytest.raises(ValueError):
+        integ.avg_imgs(imgs, weights=[1, 1])
+
+
+@pytest.mark.parametrize("method", ["median", "sigma_clip"])
+def test_avg_imgs_robust(method):
+    rng = np.random.default_rng(0)
+    imgs = [rng.normal(100.0, 1.0, (9, 7)) for _ in range(11)]
+    imgs[3][4, 5] = 1e5
+    res = integ.avg_imgs(iter(imgs), method=method, tile_size=20, threads=2)
+    stack = np.stack(imgs)
+    assert res.shape == (9, 7)
+    assert np.allclose(res, np.median(stack, axis=0), atol=2.0)
+    if method == "median":
+        assert np.array_equal(res, np.median(stack, axis=0))
+    with pytest.raises(ValueError):
+        integ.avg_imgs(imgs, weights=[1] * 11, method=method)
+
+
+def test_avg_imgs_robust_lazy(tmpdir):
+    rng = np.random.default_rng(0)
+    imgs = [rng.normal(100.0, 1.0, (9, 7)).astype(np.float32) for _ in range(5)]
+    img_files = [str(tmpdir.join("{}.tiff".format(i))) for i in range(5)]
+    for img_file, img in zip(img_files, imgs):
+        io.write_tiff(img_file, img)
+    lazy_imgs = [io.LazyImage(f) for f in img_files]
+    res = integ.avg_imgs(lazy_imgs, method="median", tile_size=20, threads=2)
+    assert res.dtype == np.float32
+    assert np.array_equal(res, integ.avg_imgs(imgs, method="median"))
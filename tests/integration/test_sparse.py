@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+import pdfstream.integration.sparse as sparse
+from pdfstream.integration.tools import integrate, integrate_stack
+
+
+@pytest.mark.parametrize(
+    "integ_setting",
+    [
+        {"npt": 1000},
+        {
+            "npt": 500,
+            "method": "bbox,csr,cython",
+            "correctSolidAngle": True,
+            "polarization_factor": 0.99,
+            "normalization_factor": 2.0,
+            "unit": "2th_deg",
+        },
+    ],
+)
+def test_integration_matrix(test_data, integ_setting):
+    img = test_data["Ni_img"]
+    mask = np.zeros_like(img, dtype=bool)
+    mask[:10] = True
+    x, expect, _ = integrate_stack(
+        [img], test_data["ai"], mask=mask, integ_setting=integ_setting
+    )
+    chi, _ = integrate(
+        img, test_data["ai"], mask=mask, integ_setting=integ_setting, use_matrix=True
+    )
+    assert np.allclose(chi[0], x)
+    assert np.allclose(chi[1], expect[0], rtol=0.0, atol=1e-6 * expect.max())
+    _, intensity, _ = integrate_stack(
+        np.stack([img, img]),
+        test_data["ai"],
+        mask=mask,
+        integ_setting=integ_setting,
+        use_matrix=True,
+    )
+    assert np.allclose(intensity, chi[1])
+
+
+def test_matrix_cache(test_data, tmpdir):
+    ai = test_data["ai"]
+    shape = test_data["Ni_img"].shape
+    cache = sparse.MatrixCache(maxsize=1)
+    m1 = cache.get(ai, shape, integ_setting={"npt": 100}, directory=tmpdir)
+    assert cache.get(ai, shape, integ_setting={"npt": 100}) is m1
+    cache.get(ai, shape, integ_setting={"npt": 200})
+    assert (cache.hits, cache.misses, len(cache)) == (1, 2, 1)
+    # load from the disk in a new cache
+    cache = sparse.MatrixCache(maxsize=1)
+    m2 = cache.get(ai, shape, integ_setting={"npt": 100}, directory=tmpdir)
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert np.array_equal(m1.matrix.toarray(), m2.matrix.toarray())
+    assert np.array_equal(m1.x, m2.x)
+
+
+def test_integration_matrix_error(test_data):
+    with pytest.raises(ValueError):
+        sparse.build_integration_matrix(
+            test_data["ai"], (2, 2), integ_setting={"dummy": 0.0}
+        )
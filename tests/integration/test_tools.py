@@ -4,7 +4,11 @@ import pytest
 
 import pdfstream.integration.tools
 import pdfstream.integration.tools as tools
+import pdfstream.io as io
 from pdfstream.integration.tools import integrate
+import pdfstream.vend.masking as masking
+from pdfstream.vend.jittools import approx_median, sigma_clip_frames
+from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
 
 
 def test_bg_sub_error():
@@ -12,6 +16,25 @@ def test_bg_sub_error():
         tools.bg_sub(np.ones((2, 2)), np.zeros((3, 3)))
 
 
+@pytest.mark.parametrize("dtype", [np.uint32, np.float32, np.float64])
+def test_sub_images(dtype):
+    rng = np.random.default_rng(0)
+    img, dk_img, bg_img = (rng.integers(0, 100, (3, 8, 8)).astype(dtype))
+    expect_dk = img.astype(np.float64) - dk_img
+    expect = expect_dk - 0.5 * bg_img
+    dk_out = np.empty(img.shape, dtype=tools.sub_dtype(img, dk_img, bg_img))
+    out = tools.sub_images(img, dk_img, bg_img, bg_scale=0.5, dk_out=dk_out)
+    assert out.dtype == (np.float64 if dtype == np.uint32 else dtype)
+    assert np.allclose(out, expect)
+    assert np.allclose(dk_out, expect_dk)
+    # clip into a reused buffer of the image type
+    out = np.empty_like(img)
+    assert tools.sub_images(img, dk_img, lower=0.0, out=out) is out
+    assert np.array_equal(out, np.clip(expect_dk, 0, None).astype(dtype))
+    with pytest.raises(ValueError):
+        tools.sub_images(img, dk_img, out=np.empty((2, 2)))
+
+
 @pytest.mark.parametrize("case", [0])
 def test_integrate(test_data, case):
     if case == 0:
@@ -26,6 +49,40 @@ def test_integrate(test_data, case):
         assert np.array_equal(chi[1], expect)
 
 
+def test_bg_file_key(tmpdir):
+    bg_file = str(tmpdir.join("bg.npy"))
+    np.save(bg_file, np.zeros(3))
+    key = tools.bg_file_key(bg_file)
+    assert key == tools.bg_file_key(bg_file)
+    assert key != tools.bg_file_key(bg_file, "float32")
+    np.save(bg_file, np.zeros(4))
+    assert key != tools.bg_file_key(bg_file)
+
+
+@pytest.mark.parametrize("stack_type", ["array", "iterator"])
+def test_integrate_stack(test_data, stack_type):
+    img = test_data["Ni_img"]
+    images = np.stack([img, 2 * img])
+    if stack_type == "iterator":
+        images = iter(images)
+    mask = np.zeros_like(img, dtype=np.uint8)
+    mask[:10] = 1
+    x, intensity, setting = tools.integrate_stack(
+        images, test_data["ai"], mask=mask, integ_setting={"npt": 1000}
+    )
+    chi, _ = integrate(img, test_data["ai"], mask=mask, integ_setting={"npt": 1000})
+    assert intensity.shape == (2, 1000)
+    assert setting["method"] == ("full", "csr", "cython")
+    assert np.allclose(x, chi[0])
+    assert np.allclose(intensity[0], chi[1], rtol=1e-5, atol=1e-5 * chi[1].max())
+    assert np.allclose(intensity[1], 2 * intensity[0], rtol=1e-5)
+
+
+def test_integrate_stack_error(test_data):
+    with pytest.raises(ValueError):
+        tools.integrate_stack(iter([]), test_data["ai"])
+
+
 @pytest.fixture
 def user_mask(request, test_data):
     if request.param == "ones":
@@ -56,3 +113,146 @@ def test_auto_mask(test_data, user_mask, mask_setting):
     plt.colorbar()
     plt.show(block=False)
     plt.close()
+
+
+@pytest.mark.parametrize(
+    "engine, auto_type",
+    [
+        ("vectorized", "median"),
+        ("numba", "median"),
+        ("numba", "mean"),
+        ("tiled", "median"),
+        ("tiled", "mean"),
+    ],
+)
+@pytest.mark.parametrize(
+    "img_key, mask_setting",
+    [
+        ("Ni_img", {"alpha": 2}),
+        ("Ni_img", {"alpha": 3, "upper_thresh": 1000}),
+        ("Kapton_img", {"alpha": 2}),
+    ],
+)
+def test_auto_mask_engine(test_data, img_key, mask_setting, engine, auto_type):
+    mask_setting = dict(mask_setting, auto_type=auto_type)
+    img = test_data[img_key]
+    expect, _ = tools.auto_mask(
+        img, test_data["ai"], mask_setting=dict(mask_setting, engine="thread")
+    )
+    mask, _ = tools.auto_mask(
+        img, test_data["ai"], mask_setting=dict(mask_setting, engine=engine)
+    )
+    assert np.array_equal(mask, expect)
+
+
+@pytest.mark.parametrize("engine", ["vectorized", "unknown"])
+def test_auto_mask_engine_error(test_data, engine):
+    with pytest.raises(ValueError):
+        tools.auto_mask(
+            test_data["Ni_img"],
+            test_data["ai"],
+            mask_setting={"engine": engine, "auto_type": "mean"},
+        )
+
+
+def test_auto_mask_shared_pool(test_data):
+    pool = masking.get_mask_pool()
+    for _ in range(2):
+        tools.auto_mask(
+            test_data["Ni_img"], test_data["ai"], mask_setting={"engine": "thread"}
+        )
+    assert masking.get_mask_pool() is pool
+    masking.set_mask_pool_size(4)
+    assert masking.get_mask_pool() is not pool
+    masking.shutdown_mask_pool()
+    masking.set_mask_pool_size(20)
+    with pytest.raises(ValueError):
+        masking.set_mask_pool_size(0)
+
+
+def test_mask_drift(test_data):
+    img = test_data["Ni_img"]
+    binner = masking.generate_binner(test_data["ai"], img.shape)
+    prior = masking.prior_mask(img)
+    mask = masking.mask_img(img, binner, alpha=2.0)
+    values, _, offsets = masking.ring_segments(img, binner, prior)
+    median, std = masking.ring_stats(values, offsets)
+    kwargs = dict(alpha=2.0, fraction=0.05, tmsk=prior, seed=0)
+    same = masking.mask_drift(img, binner, mask, median, std, **kwargs)
+    scaled = masking.mask_drift(img * 2.0, binner, mask, median, std, **kwargs)
+    assert same < 0.01
+    assert scaled > same
+
+
+def test_generate_map_bin(test_data):
+    ai = test_data["ai"]
+    shape = test_data["white_img"].shape
+    assert np.array_equal(masking.delta_q(ai, shape), ai.deltaQ(shape))
+    r = ai.rArray(shape).ravel()
+    dq = ai.deltaQ(shape).ravel()
+    rbins = np.linspace(r.min(), r.max(), 500)
+    expect = BinnedStatistic1D(r, statistic=np.max, bins=rbins)(dq)
+    assert np.array_equal(masking.binned_max(r, dq, rbins), np.nan_to_num(expect))
+
+
+@pytest.mark.parametrize(
+    "mask_setting",
+    [{"alpha": 2}, {"alpha": 3, "upper_thresh": 1000}, {"auto_type": "mean"}],
+)
+def test_auto_mask_stack(test_data, mask_setting):
+    img = test_data["Ni_img"]
+    stack = np.stack([img, test_data["Kapton_img"], img])
+    packed, _ = tools.auto_mask_stack(stack, test_data["ai"], mask_setting=mask_setting)
+    masks = io.unpack_mask(packed, stack.shape)
+    for frame, mask in zip(stack, masks):
+        expect, _ = tools.auto_mask(frame, test_data["ai"], mask_setting=mask_setting)
+        assert np.array_equal(mask, expect)
+
+
+def test_approx_median():
+    values = np.random.default_rng(0).normal(100.0, 10.0, 100000)
+    assert approx_median(values[:1000]) == np.median(values[:1000])
+    assert abs(approx_median(values) - np.median(values)) < 0.11 * 10.0
+
+
+@pytest.mark.parametrize("engine", ["numba", "thread"])
+def test_auto_mask_approx_median(test_data, engine):
+    img = test_data["Ni_img"]
+    expect, _ = tools.auto_mask(img, test_data["ai"], mask_setting={"alpha": 3})
+    mask, _ = tools.auto_mask(
+        img,
+        test_data["ai"],
+        mask_setting={"alpha": 3, "auto_type": "approx_median", "engine": engine},
+    )
+    assert np.mean(mask != expect) < 1e-3
+
+
+def test_mask_buffers(test_data):
+    img = test_data["Ni_img"]
+    binner = masking.generate_binner(test_data["ai"], img.shape)
+    tmsk = img >= 0
+    expect = masking.binned_outlier(img, binner, tmsk, alpha=2)
+    buffers = masking.MaskBuffers(chunk_size=1000)
+    for _ in range(2):
+        mask = masking._binned_outlier_tiled(img, binner, tmsk, alpha=2, buffers=buffers)
+        assert np.array_equal(mask, expect)
+
+
+def test_sigma_clip_frames():
+    rng = np.random.default_rng(0)
+    stack = rng.normal(10.0, 1.0, (15, 40))
+    stack[2, :5] = 100.0
+    out = np.empty(40)
+    sigma_clip_frames(stack, 3.0, 5, out)
+    expect = np.empty(40)
+    for i in range(40):
+        values = stack[:, i]
+        keep = np.ones(len(values), dtype=bool)
+        for _ in range(5):
+            center, std = np.median(values[keep]), np.std(values[keep])
+            new = np.abs(values - center) <= 3.0 * std
+            if np.array_equal(new, keep):
+                break
+            keep = new
+        expect[i] = values[keep].mean()
+    assert np.allclose(out, expect)
@@ -0,0 +1,36 @@
+import numpy as np
+from frozendict import frozendict
+
+import pdfstream.cache as mod
+from pdfstream.vend.masking import generate_binner, mask_img
+
+
+def test_get_ring_index(test_data, tmpdir):
+    ai = test_data["ai"]
+    img = test_data["white_img"]
+    calib = frozendict(dist=ai.dist, poni1=ai.poni1, poni2=ai.poni2)
+    ring_index = mod.get_ring_index(ai, calib, img.shape, str(tmpdir))
+    loaded = mod.get_ring_index(ai, calib, img.shape, str(tmpdir))
+    assert isinstance(loaded.argsort_index, np.memmap)
+    assert np.array_equal(loaded.flatcount, ring_index.flatcount)
+    binner = generate_binner(ai, img.shape)
+    assert np.array_equal(ring_index.flatcount, binner.flatcount)
+    expect = mask_img(img, binner)
+    assert np.array_equal(mask_img(img, loaded), expect)
+
+
+def test_get_ring_index_broken_cache(test_data, tmpdir):
+    ai = test_data["ai"]
+    shape = test_data["white_img"].shape
+    calib = frozendict(dist=ai.dist)
+    key = mod.calib_key(calib, shape)
+    tmpdir.mkdir(key).join("q.npy").write("broken")
+    assert mod.load_ring_index(str(tmpdir), key) is None
+    mod.get_ring_index(ai, calib, shape, str(tmpdir))
+    assert mod.load_ring_index(str(tmpdir), key) is not None
+
+
+def test_calib_key():
+    calib = frozendict(dist=0.2, poni1=0.1)
+    assert mod.calib_key(calib, (2, 2)) == mod.calib_key(dict(poni1=0.1, dist=0.2), (2, 2))
+    assert mod.calib_key(calib, (2, 2)) != mod.calib_key(calib, (2, 3))
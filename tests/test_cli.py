@@ -1,3 +1,4 @@
+import shutil
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
@@ -15,6 +16,23 @@ import pdfstream.io as io
         (None, None, {}),
         ("Ni_img_file", "mask_file", {}),
         (None, None, {"parallel": True, "plot_setting": "OFF", "img_setting": "OFF"}),
+        (
+            None,
+            "mask_file",
+            {"parallel": True, "mask_setting": "OFF", "plot_setting": "OFF", "img_setting": "OFF"},
+        ),
+        (
+            None,
+            "mask_file",
+            {
+                "parallel": True,
+                "mask_setting": "OFF",
+                "use_matrix": True,
+                "plot_setting": "OFF",
+                "img_setting": "OFF",
+            },
+        ),
+        (None, None, {"prefetch": 0}),
     ],
 )
 def test_integrate(test_data, bg_img_file, mask_file, kwargs):
@@ -34,7 +52,62 @@ def test_integrate(test_data, bg_img_file, mask_file, kwargs):
     plt.close()
 
 
-@pytest.mark.parametrize("kwargs", [{}, {"weights": [1, 1]}])
+def test_integrate_load_once(test_data, monkeypatch):
+    loaded = []
+
+    def load_ai(poni_file):
+        loaded.append(poni_file)
+        return test_data["ai"]
+
+    monkeypatch.setattr(io, "load_ai_from_poni_file", load_ai)
+    img_file = test_data["Ni_img_file"]
+    with TemporaryDirectory() as tempdir:
+        chi_files = cli.integrate(
+            test_data["Ni_poni_file"],
+            img_file,
+            img_file,
+            output_dir=tempdir,
+            mask_setting="OFF",
+            plot_setting="OFF",
+            img_setting="OFF",
+            test=True,
+        )
+        assert len(chi_files) == 2
+    assert loaded == [test_data["Ni_poni_file"]]
+    plt.close()
+
+
+def test_integrate_bg_mode_warning(test_data):
+    with TemporaryDirectory() as tempdir:
+        with pytest.warns(UserWarning):
+            cli.integrate(
+                test_data["Ni_poni_file"],
+                test_data["Ni_img_file"],
+                bg_img_file=test_data["Kapton_img_file"],
+                output_dir=tempdir,
+                bg_mode="1d",
+                plot_setting="OFF",
+                img_setting="OFF",
+                test=True,
+            )
+    plt.close()
+
+
+def test_watch(test_data):
+    with TemporaryDirectory() as tempdir:
+        img_file = Path(tempdir).joinpath("Ni.tiff")
+        shutil.copy(test_data["Ni_img_file"], img_file)
+        kwargs = dict(mask_setting="OFF", settle_time=0.1, poll_interval=0.1, timeout=0.5)
+        chi_files = cli.watch(test_data["Ni_poni_file"], tempdir, **kwargs)
+        assert chi_files == [str(img_file.with_suffix(".chi"))]
+        # the manifest skips the images done
+        assert cli.watch(test_data["Ni_poni_file"], tempdir, **kwargs) == []
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{}, {"weights": [1, 1]}, {"prefetch": 0}, {"method": "median"}, {"method": "sigma_clip"}],
+)
 def test_average(test_data, kwargs):
     with TemporaryDirectory() as tempdir:
         img_file = Path(tempdir).joinpath("new_dir/average.tiff")
@@ -0,0 +1,50 @@
+import pytest
+
+from pdfstream.callbacks.config import Config, ConfigError
+
+
+@pytest.mark.parametrize(
+    "option,value,key,expect",
+    [
+        ("mask_engine", "", "engine", None),
+        ("mask_engine", "tiled", "engine", "tiled"),
+        ("auto_type", "", "auto_type", "median"),
+        ("auto_type", "mean", "auto_type", "mean"),
+    ],
+)
+def test_mask_setting(option, value, key, expect):
+    config = Config()
+    config.set("ANALYSIS", option, value)
+    assert config.mask_setting[key] == expect
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"mask_engine": "gpu"},
+        {"auto_type": "max"},
+        {"mask_engine": "vectorized", "auto_type": "mean"},
+    ],
+)
+def test_mask_setting_error(options):
+    config = Config()
+    for option, value in options.items():
+        config.set("ANALYSIS", option, value)
+    with pytest.raises(ConfigError):
+        config.mask_setting
+
+
+@pytest.mark.parametrize(
+    "options,expect",
+    [
+        ({"integ_matrix": "True"}, False),
+        ({"integ_matrix": "True", "auto_mask": "False"}, True),
+        ({"integ_matrix": "True", "mask_policy": "first_frame"}, True),
+        ({"integ_matrix": "False", "mask_policy": "first_frame"}, False),
+    ],
+)
+def test_use_integ_matrix(options, expect):
+    config = Config()
+    for option, value in options.items():
+        config.set("ANALYSIS", option, value)
+    assert config.use_integ_matrix is expect
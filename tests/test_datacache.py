@@ -0,0 +1,31 @@
+import numpy as np
+
+import pdfstream.datacache as mod
+import pdfstream.io as io
+
+
+def test_data_file_cache(test_data, tmpdir):
+    data_file = tmpdir.join("Ni.chi")
+    data_file.write(open(test_data["Ni_chi_file"]).read())
+    expect = io.load_array(str(data_file))
+    # the sidecar file next to the data file
+    data_cache = mod.DataFileCache()
+    assert np.array_equal(data_cache.load(str(data_file)), expect)
+    loaded = data_cache.load(str(data_file))
+    assert type(loaded) is np.ndarray
+    assert loaded.flags.writeable
+    assert np.array_equal(loaded, expect)
+    assert (data_cache.hits, data_cache.misses) == (1, 1)
+    # the modified file is parsed again and the stale sidecar is removed
+    data_file.write("  1.0  2.0\n", mode="a")
+    assert data_cache.load(str(data_file)).shape[1] == expect.shape[1] + 1
+    assert len(tmpdir.listdir(lambda p: p.ext == ".npy")) == 1
+    # the cache directory with the eviction
+    data_cache = mod.DataFileCache(str(tmpdir.join("cache")), max_bytes=expect.nbytes + 1024)
+    for i in range(3):
+        copied = tmpdir.join("{}.chi".format(i))
+        data_file.copy(copied)
+        data_cache.load(str(copied))
+    assert len(tmpdir.join("cache").listdir()) == 1
+    data_cache.enabled = False
+    assert np.array_equal(data_cache.load(str(data_file))[:, :-1], expect)
@@ -1,8 +1,10 @@
 import numpy as np
 import pyFAI
 import pytest
+import tifffile
 
 import pdfstream.io as mod
+import pdfstream.vend.loaddata as loaddata
 
 
 @pytest.fixture(scope="module")
@@ -41,6 +43,20 @@ def test_load_matrix_flexible(tmpdir):
         assert np.array_equal(matrix1, matrix)
 
 
+@pytest.mark.parametrize("kwargs", [{}, {"byteorder": ">"}, {"compression": "zlib"}])
+def test_lazy_image(tmpdir, kwargs):
+    tiff_file = str(tmpdir.join("test.tiff"))
+    img = np.arange(35, dtype=np.uint16).reshape(5, 7)
+    tifffile.imwrite(tiff_file, img, **kwargs)
+    lazy_img = mod.LazyImage(tiff_file)
+    assert lazy_img.shape == img.shape
+    assert lazy_img.dtype == img.dtype
+    assert np.array_equal(lazy_img[1:3], img[1:3])
+    assert np.array_equal(lazy_img[4:9], img[4:9])
+    assert np.array_equal(lazy_img[::2], img[::2])
+    assert np.array_equal(np.asarray(lazy_img), img)
+
+
 def test_load_matrix_flexible_error():
     with pytest.raises(ValueError):
         mod.load_matrix_flexible("test.jpg")
@@ -52,3 +68,43 @@ def test_server_message():
     mod.server_message("test 2")
     mod.verbose()
     mod.server_message("test 3")
+
+
+def test_pack_mask():
+    mask = np.random.default_rng(0).random((5, 13)) > 0.5
+    packed = mod.pack_mask(mask)
+    assert packed.shape == (5, 2)
+    assert np.array_equal(mod.unpack_mask(packed, mask.shape), mask)
+    assert np.array_equal(mod.unpack_mask(mask.astype(int), mask.shape), mask)
+    with pytest.raises(ValueError):
+        mod.unpack_mask(packed, (5, 20))
+
+
+def test_save_and_load_mask(tmpdir):
+    mask = np.zeros((5, 13), dtype=bool)
+    mask[1, ::3] = True
+    npz_file = str(tmpdir.join("mask.npz"))
+    npy_file = str(tmpdir.join("mask.npy"))
+    mod.save_mask(npz_file, mask)
+    np.save(npy_file, mask.astype(int))
+    for f in [npz_file, npy_file]:
+        loaded = mod.load_mask(f)
+        assert loaded.dtype == bool
+        assert np.array_equal(loaded, mask)
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        "x y\n",
+        "# q I\n#\n",
+        "nan inf\n1 2 3\n",
+        "distance: 0.2 m\n1e-3 x\n",
+    ],
+)
+def test_load_data_header(tmpdir, header):
+    data_file = str(tmpdir.join("data.txt"))
+    with open(data_file, "w") as f:
+        f.write(header + "1 2\n3 nan\n5 6\n")
+    data = loaddata.load_data(data_file, minrows=3)
+    assert np.array_equal(data, [[1, 2], [3, np.nan], [5, 6]], equal_nan=True)
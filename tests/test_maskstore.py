@@ -0,0 +1,41 @@
+import numpy as np
+
+from pdfstream.callbacks.maskstore import MaskStore, StaticMask, mask_key
+
+
+def _static_mask(i):
+    return StaticMask(np.full((4, 4), i), np.arange(3.0), np.ones(3))
+
+
+def test_mask_key():
+    key = mask_key({"dist": 0.2}, None, {"alpha": 3, "engine": "numba"}, (4, 4))
+    assert key == mask_key({"dist": 0.2}, None, {"alpha": 3, "engine": "thread"}, (4, 4))
+    assert key != mask_key({"dist": 0.2}, "user", {"alpha": 3}, (4, 4))
+    assert key != mask_key({"dist": 0.2}, None, {"alpha": 2}, (4, 4))
+
+
+def test_mask_store(tmpdir):
+    keys = [mask_key({"dist": i}, None, {}, (4, 4)) for i in range(5)]
+    store = MaskStore(2, str(tmpdir), 3)
+    for i, key in enumerate(keys):
+        store.put(key, _static_mask(i))
+    assert len(store) == 2
+    assert sorted(p.basename for p in tmpdir.listdir()) == sorted(keys[2:])
+    assert store.get(keys[0]) is None
+    assert store.get(keys[4]).mask[0, 0] == 4
+    # load from the disk in a new store
+    new_store = MaskStore(2, str(tmpdir), 3)
+    static_mask = new_store.get(keys[3])
+    assert static_mask.mask[0, 0] == 3
+    assert static_mask.frames == 0
+    assert (new_store.hits, new_store.misses) == (1, 0)
+    assert (store.hits, store.misses) == (1, 1)
+
+
+def test_mask_store_no_stats(tmpdir):
+    key = mask_key({"dist": 0.2}, None, {}, (4, 4))
+    assert not StaticMask(np.zeros((4, 4))).has_stats
+    MaskStore(2, str(tmpdir)).put(key, StaticMask(np.zeros((4, 4))))
+    static_mask = MaskStore(2, str(tmpdir)).get(key)
+    assert not static_mask.has_stats
+    assert _static_mask(0).has_stats
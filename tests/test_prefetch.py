@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+from pdfstream.prefetch import PrefetchReader
+
+
+@pytest.mark.parametrize("depth, threads", [(0, 1), (1, 1), (4, 2), (16, 3)])
+def test_prefetch_reader(depth, threads):
+    files = list(range(10))
+    reader = PrefetchReader(files, loader=lambda f: f * 2, depth=depth, threads=threads)
+    assert list(reader) == [(f, f * 2) for f in files]
+    assert reader.frames == len(files)
+    assert max(reader.queue_depths) <= max(depth, 0)
+    reader.report()
+
+
+def test_prefetch_reader_bounded():
+    loaded = []
+    lock = threading.Lock()
+
+    def loader(f):
+        with lock:
+            loaded.append(f)
+        return f
+
+    reader = iter(PrefetchReader(range(100), loader=loader, depth=3, threads=2))
+    assert next(reader) == (0, 0)
+    reader.close()
+    # the consumed frame and at most depth frames ahead
+    assert len(loaded) <= 4
+
+
+def test_prefetch_reader_error():
+    def loader(f):
+        if f == 2:
+            raise OSError("broken file")
+        return f
+
+    reader = PrefetchReader(range(5), loader=loader, depth=2)
+    with pytest.raises(OSError):
+        list(reader)
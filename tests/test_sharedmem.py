@@ -0,0 +1,46 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from pdfstream.sharedmem import SharedArrays, attach_arrays, detach_arrays
+
+
+def _sum_shared(specs):
+    arrays = attach_arrays(specs)
+    total = float(arrays["a"].sum())
+    del arrays
+    detach_arrays()
+    return total
+
+
+def test_shared_arrays():
+    a = np.arange(12, dtype=np.float32).reshape(3, 4)
+    with SharedArrays() as shared:
+        shared.publish("a", a)
+        shared.publish("b", None)
+        specs = shared.specs
+        arrays = attach_arrays(specs)
+        assert np.array_equal(arrays["a"], a)
+        assert arrays["b"] is None
+        assert not arrays["a"].flags.writeable
+        with pytest.raises(KeyError):
+            shared.publish("a", a)
+        with ProcessPoolExecutor(1) as executor:
+            assert executor.submit(_sum_shared, specs).result() == a.sum()
+        del arrays
+        detach_arrays()
+    # the blocks are removed
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=specs["a"][0])
+
+
+def test_shared_arrays_interrupted():
+    with pytest.raises(KeyboardInterrupt):
+        with SharedArrays() as shared:
+            shared.publish("a", np.ones(4))
+            name = shared.specs["a"][0]
+            raise KeyboardInterrupt
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
@@ -0,0 +1,58 @@
+import threading
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from pdfstream.watch import DirectoryWatcher, Manifest, file_state
+
+
+def _write_later(path: Path, parts: int, delay: float):
+    with path.open("wb") as f:
+        for _ in range(parts):
+            f.write(b"0" * 10)
+            f.flush()
+            time.sleep(delay)
+    return
+
+
+@pytest.mark.parametrize("poll", [True, False])
+def test_directory_watcher(poll):
+    with TemporaryDirectory() as tempdir:
+        directory = Path(tempdir)
+        directory.joinpath("a.tiff").write_bytes(b"a")
+        directory.joinpath("b.txt").write_bytes(b"b")
+        writer = threading.Thread(target=_write_later, args=(directory.joinpath("c.tiff"), 5, 0.1))
+        watcher = DirectoryWatcher(directory, settle_time=0.3, poll_interval=0.05, poll=poll, timeout=1.0)
+        found = []
+        for path in watcher:
+            if not found:
+                writer.start()
+            found.append((path.name, path.stat().st_size))
+        writer.join()
+        # the partially written file is not yielded
+        assert found == [("a.tiff", 1), ("c.tiff", 50)]
+
+
+def test_directory_watcher_seen():
+    with TemporaryDirectory() as tempdir:
+        directory = Path(tempdir)
+        for name in ("a.tiff", "b.tiff"):
+            directory.joinpath(name).write_bytes(b"0")
+        seen = {"a.tiff": file_state(directory.joinpath("a.tiff"))}
+        watcher = DirectoryWatcher(directory, settle_time=0.0, poll=True, poll_interval=0.05, timeout=0.2, seen=seen)
+        assert [p.name for p in watcher] == ["b.tiff"]
+
+
+def test_manifest():
+    with TemporaryDirectory() as tempdir:
+        path = Path(tempdir).joinpath("manifest.jsonl")
+        manifest = Manifest(path)
+        manifest.record("a.tiff", (1, 2), "a.chi")
+        with path.open("a") as f:
+            f.write('{"name": "b.ti')
+        manifest = Manifest(path)
+        assert manifest.states == {"a.tiff": (1, 2)}
+        manifest.record("c.tiff", (3, 4))
+        assert Manifest(path).states == {"a.tiff": (1, 2), "c.tiff": (3, 4)}